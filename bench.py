@@ -0,0 +1,287 @@
+"""本地微基准：python bench.py
+
+不依赖后端，只测量客户端本地的 CPU 开销。
+"""
+
+import asyncio
+import base64
+import json
+import os
+import queue
+import random
+import time
+
+from crypto_utils import (
+    generate_rsa_keys,
+    generate_x25519_keys,
+    generate_ed25519_keys,
+    gen_sym_key,
+    aes_gcm_encrypt,
+    aes_gcm_decrypt,
+    rsa_encrypt,
+    rsa_decrypt,
+    derive_session_key,
+    ed25519_sign,
+    verify_signature,
+)
+from crypto_executor import CryptoExecutor
+from compression import supported_algorithms, encode_payload, decode_payload
+import json_codec
+import sse
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+
+def _timeit(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+def _report(name, seconds):
+    print(f"  {name:<36} {seconds * 1e6:10.1f} us/op {1 / seconds:10.0f} op/s")
+
+
+def bench_handshake(n=200):
+    """一次完整会话建立的 CPU 开销：RSA 密钥交换 (v1) vs X25519 + HKDF (v2)"""
+    print("=== 会话建立 (handshake) ===")
+    a_priv, a_pub = generate_rsa_keys()
+    b_priv, b_pub = generate_rsa_keys()
+
+    def rsa_handshake():
+        # 发起方包装 -> 接收方解包并回包确认 -> 发起方解包确认
+        K = gen_sym_key()
+        received = rsa_decrypt(b_priv, rsa_encrypt(b_pub, K))
+        rsa_decrypt(a_priv, rsa_encrypt(a_pub, received))
+
+    a_ecdh, a_ecdh_pub = generate_x25519_keys()
+    b_ecdh, b_ecdh_pub = generate_x25519_keys()
+
+    def x25519_handshake():
+        # 双方各做一次 X25519 + HKDF，无需往返
+        salt = os.urandom(16)
+        derive_session_key(a_ecdh, b_ecdh_pub, salt, 1, 2)
+        derive_session_key(b_ecdh, a_ecdh_pub, salt, 2, 1)
+
+    rsa_cost = _timeit(rsa_handshake, n)
+    ecdh_cost = _timeit(x25519_handshake, n)
+    _report("RSA-2048 PKCS1v15 (v1)", rsa_cost)
+    _report("X25519 + HKDF-SHA256 (v2)", ecdh_cost)
+    print(f"  v2 加速比: {rsa_cost / ecdh_cost:.1f}x")
+
+
+def bench_presence_verify(n=500):
+    """在线列表中每个用户的服务器签名校验：RSA vs Ed25519"""
+    print("=== 在线列表签名校验 ===")
+    message = base64.b64encode(os.urandom(300))
+
+    rsa_priv, rsa_pub = generate_rsa_keys()
+    rsa_sig = rsa_priv.sign(message, padding.PKCS1v15(), hashes.SHA256())
+    ed_priv, ed_pub = generate_ed25519_keys()
+    ed_sig = ed25519_sign(ed_priv, message)
+
+    _report(
+        "RSA-2048 verify",
+        _timeit(lambda: verify_signature(rsa_pub, message, rsa_sig), n),
+    )
+    _report(
+        "Ed25519 verify", _timeit(lambda: verify_signature(ed_pub, message, ed_sig), n)
+    )
+
+
+def bench_loop_latency(storm=200, interval=0.005):
+    """握手风暴下的事件循环延迟：RSA 解包在循环内执行 vs 交给 CryptoExecutor"""
+    print(f"=== 握手风暴下的事件循环延迟 ({storm} 次 RSA 解包) ===")
+    priv, pub = generate_rsa_keys()
+    wrapped = [rsa_encrypt(pub, gen_sym_key()) for _ in range(storm)]
+
+    async def measure(handle):
+        loop = asyncio.get_running_loop()
+        lags = []
+        done = asyncio.Event()
+
+        async def ticker():
+            # 每 interval 醒来一次，实际间隔超出的部分就是循环被阻塞的时间
+            while not done.is_set():
+                t = loop.time()
+                await asyncio.sleep(interval)
+                lags.append(loop.time() - t - interval)
+
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(interval * 2)
+        start = time.perf_counter()
+        await asyncio.gather(*(handle(c) for c in wrapped))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await tick
+        return elapsed, sorted(lags)
+
+    async def inline(ciphertext):
+        rsa_decrypt(priv, ciphertext)
+
+    executor = CryptoExecutor()
+
+    async def offloaded(ciphertext):
+        await executor.run(rsa_decrypt, priv, ciphertext)
+
+    for name, handle in (("循环内执行", inline), ("CryptoExecutor", offloaded)):
+        elapsed, lags = asyncio.run(measure(handle))
+        p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+        print(
+            f"  {name:<16} 总耗时 {elapsed * 1e3:7.1f} ms  "
+            f"最大延迟 {lags[-1] * 1e3:7.1f} ms  p99 {p99 * 1e3:7.1f} ms"
+        )
+
+
+def _sample_payloads():
+    rng = random.Random(0)
+    levels = ["INFO", "DEBUG", "WARN", "ERROR"]
+    log = "\n".join(
+        f"2025-11-0{rng.randint(1, 9)} 12:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} "
+        f"[{rng.choice(levels)}] ws_client: 用户 {rng.randint(1, 500)} 消息处理耗时 "
+        f"{rng.random() * 20:.3f} ms"
+        for _ in range(300)
+    )
+    records = json.dumps(
+        [
+            {
+                "id": i,
+                "fromId": rng.randint(1, 50),
+                "toId": rng.randint(1, 50),
+                "chat": "今天的作业进度同步一下",
+                "createTime": f"2025-11-01 10:{i % 60:02d}:00",
+            }
+            for i in range(200)
+        ],
+        ensure_ascii=False,
+    )
+    with open(__file__, "r", encoding="utf-8") as f:
+        code = f.read()
+    return [
+        ("短聊天消息", "好的，明天下午三点开会"),
+        ("日志", log),
+        ("JSON 记录", records),
+        ("Python 源码", code),
+        ("base64 文件数据", base64.b64encode(os.urandom(16 * 1024)).decode()),
+    ]
+
+
+def bench_compression(n=200):
+    """加密前压缩：线上字节数（base64 后）与单条编码/解码 CPU 开销"""
+    print("=== 加密前压缩 ===")
+    K = gen_sym_key()
+    for name, text in _sample_payloads():
+        print(f"  {name} ({len(text.encode())} 字节明文)")
+        for algorithm in [None] + supported_algorithms():
+            payload = encode_payload(text, algorithm)
+
+            def encode():
+                iv, ct, tag = aes_gcm_encrypt(K, encode_payload(text, algorithm))
+                return base64.b64encode(iv + ct + tag)
+
+            wire = encode()
+            raw = base64.b64decode(wire)
+
+            def decode():
+                decode_payload(aes_gcm_decrypt(K, raw[:12], raw[12:-16], raw[-16:]))
+
+            enc_cost = _timeit(encode, n)
+            dec_cost = _timeit(decode, n)
+            label = algorithm or "不压缩"
+            if algorithm and payload[:1] != b"\xff":
+                label += "(跳过)"
+            print(
+                f"    {label:<10} 线上 {len(wire):8d} 字节  "
+                f"编码 {enc_cost * 1e6:9.1f} us  解码 {dec_cost * 1e6:9.1f} us"
+            )
+
+
+def _sample_frames():
+    rng = random.Random(1)
+    message = {
+        "fromId": 12,
+        "toId": 34,
+        "message": base64.b64encode(os.urandom(120)).decode(),
+        "aesKey": base64.b64encode(os.urandom(256)).decode(),
+        "caps": "zstd,zlib,seq",
+        "seq": 1024,
+    }
+    presence = {
+        "systemMessage": True,
+        "message": [
+            {
+                "id": i,
+                "username": f"user{i}",
+                "publicKey": "-----BEGIN PUBLIC KEY-----\n"
+                + base64.b64encode(os.urandom(294)).decode()
+                + "\n-----END PUBLIC KEY-----\n",
+                "signature": base64.b64encode(os.urandom(256)).decode(),
+            }
+            for i in range(100)
+        ],
+    }
+    history = [
+        {
+            "id": i,
+            "fromId": rng.randint(1, 50),
+            "toId": rng.randint(1, 50),
+            "chat": base64.b64encode(os.urandom(rng.randint(40, 400))).decode(),
+            "aesKey": base64.b64encode(os.urandom(256)).decode(),
+            "createTime": f"2025-11-01 10:{i % 60:02d}:00",
+        }
+        for i in range(200)
+    ]
+    return [
+        ("消息帧", message),
+        ("在线列表 (100 人)", presence),
+        ("聊天记录 (200 条)", history),
+    ]
+
+
+def bench_json(n=2000):
+    """JSON 编解码：标准库 json 与 json_codec 当前后端的单帧开销"""
+    print(f"=== JSON 编解码（json_codec 后端: {json_codec.BACKEND}） ===")
+    for name, obj in _sample_frames():
+        raw = json.dumps(obj)
+        count = max(20, n * 200 // max(len(raw), 200))
+        print(f"  {name} ({len(raw)} 字节)")
+        _report("json.dumps", _timeit(lambda: json.dumps(obj), count))
+        _report("json_codec.dumps", _timeit(lambda: json_codec.dumps(obj), count))
+        _report("json.loads", _timeit(lambda: json.loads(raw), count))
+        _report("json_codec.loads", _timeit(lambda: json_codec.loads(raw), count))
+
+    # SSE 推送给 10 个订阅者：原先每个连接各自格式化，现在每个事件只编码一次
+    event = {"fromId": 12, "content": "好的，明天下午三点开会", "seq": 42}
+    subscribers = 10
+    queues = [queue.Queue() for _ in range(subscribers)]
+
+    def per_subscriber():
+        for q in queues:
+            q.put_nowait(b"data: " + json.dumps(event).encode() + b"\n\n")
+        for q in queues:
+            q.get_nowait()
+
+    broadcaster = sse.EventBroadcaster()
+    subscribed = [broadcaster.subscribe() for _ in range(subscribers)]
+
+    def publish():
+        broadcaster.publish(event)
+        for q in subscribed:
+            q.get_nowait()
+
+    print(f"  SSE 事件广播（{subscribers} 个订阅者）")
+    _report("每个订阅者各编码一次", _timeit(per_subscriber, n))
+    _report("EventBroadcaster.publish", _timeit(publish, n))
+
+
+def main():
+    bench_handshake()
+    bench_presence_verify()
+    bench_loop_latency()
+    bench_compression()
+    bench_json()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd 为可选依赖，未安装时只协商 zlib
+    zstandard = None
+
+COMPRESS_THRESHOLD = 1024  # 明文小于该字节数时不压缩
+MAX_DECOMPRESSED_SIZE = 4 * 1024 * 1024  # 解压上限，防止解压炸弹
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# 压缩后的明文格式: 0xFF + 算法编号 + 压缩数据（在 AES-GCM 加密之内，受认证保护）
+# UTF-8 文本不会出现 0xFF 字节，未压缩的旧格式消息可以直接区分
+_MAGIC = 0xFF
+_ALGO_IDS = {"zlib": 1, "zstd": 2}
+
+
+def supported_algorithms():
+    """本端支持的压缩算法，按优先级排列；随消息帧的 caps 字段发给对方"""
+    if zstandard is not None:
+        return ["zstd", "zlib"]
+    return ["zlib"]
+
+
+def choose_algorithm(peer_caps):
+    """选择双方都支持的最优算法；对方未声明能力时不压缩"""
+    for algorithm in supported_algorithms():
+        if algorithm in peer_caps:
+            return algorithm
+    return None
+
+
+def encode_payload(text, algorithm=None, threshold=COMPRESS_THRESHOLD):
+    """明文 -> 待加密字节；超过阈值且压缩有收益时才压缩"""
+    data = text.encode()
+    if algorithm is None or len(data) < threshold:
+        return data
+
+    if algorithm == "zstd":
+        compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    else:
+        compressed = zlib.compress(data, ZLIB_LEVEL)
+
+    if len(compressed) + 2 >= len(data):
+        return data  # 不可压缩的内容原样发送
+    return bytes((_MAGIC, _ALGO_IDS[algorithm])) + compressed
+
+
+def decode_payload(data, max_size=MAX_DECOMPRESSED_SIZE):
+    """解密后的字节 -> 明文；解压结果超过 max_size 时抛出 ValueError"""
+    if not data or data[0] != _MAGIC:
+        return data.decode()
+
+    if len(data) < 2:
+        raise ValueError("压缩消息格式错误")
+    algorithm_id, body = data[1], data[2:]
+
+    if algorithm_id == _ALGO_IDS["zlib"]:
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(body, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("解压后超过大小上限")
+        if not decompressor.eof:
+            raise ValueError("压缩数据不完整")
+    elif algorithm_id == _ALGO_IDS["zstd"]:
+        if zstandard is None:
+            raise ValueError("未安装 zstandard，无法解压")
+        # 流式读取，不信任帧头中声明的原始大小
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body))
+        chunks = []
+        total = 0
+        while True:
+            chunk = reader.read(65536)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > max_size:
+                raise ValueError("解压后超过大小上限")
+            chunks.append(chunk)
+        out = b"".join(chunks)
+    else:
+        raise ValueError(f"未知压缩算法: {algorithm_id}")
+
+    return out.decode()
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# cryptography 在 OpenSSL 运算期间会释放 GIL，线程池即可真正并行；
+# 私钥对象无法 pickle，所以不使用进程池
+CRYPTO_WORKERS = min(4, os.cpu_count() or 1)
+MAX_PENDING = 64  # 每个事件循环同时在途的加解密任务上限
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_crypto_pool():
+    """所有 WSClient 共享同一个加解密线程池，线程数不随登录用户数增长"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto"
+            )
+        return _pool
+
+
+class CryptoExecutor:
+    """把 RSA 私钥运算等耗时操作放到线程池，事件循环只负责等待结果
+
+    max_pending 限制同时在途的任务数，超出时调用方在 await 处排队，
+    不会把任务无限堆进线程池。
+    """
+
+    def __init__(self, pool=None, max_pending=MAX_PENDING):
+        self.pool = pool
+        self.max_pending = max_pending
+        self._semaphore = None  # 在所属事件循环中延迟创建
+
+    async def run(self, fn, *args):
+        if self.pool is None:
+            self.pool = get_crypto_pool()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, fn, *args)
@@ -1,8 +1,10 @@
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519, ed25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
+import base64
 import os
 
 import random
@@ -82,6 +84,69 @@ def rsa_verify(public_key, message: bytes, signature: bytes) -> bool:
     return True
 
 
+def verify_signature(public_key, message: bytes, signature: bytes) -> bool:
+    """按公钥类型校验签名：Ed25519 直接校验，RSA 使用 PKCS1v15 + SHA256"""
+    if isinstance(public_key, (str, bytes)):
+        if isinstance(public_key, str):
+            public_key = public_key.encode()
+        public_key = serialization.load_pem_public_key(public_key)
+
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        public_key.verify(signature, message)
+    else:
+        public_key.verify(signature, message, padding.PKCS1v15(), hashes.SHA256())
+    return True
+
+
+# === elliptic-curve (protocol v2) ===#
+
+# v2 会话的 aesKey 字段格式: "x25519:" + base64(salt)
+# 双方用各自的 X25519 静态私钥和对方公钥算出相同的共享秘密，再用 salt 经 HKDF 派生 AES key，
+# 不需要 RSA 密钥交换的往返，历史记录两端也都能重新派生
+ECDH_KEY_PREFIX = "x25519:"
+
+
+def generate_x25519_keys():
+    private_key = x25519.X25519PrivateKey.generate()
+    return private_key, private_key.public_key()
+
+
+def generate_ed25519_keys():
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    return private_key, private_key.public_key()
+
+
+def serialize_raw_public_key(pub):
+    """X25519/Ed25519 公钥 -> base64(32 字节原始公钥)"""
+    raw = pub.public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+    return base64.b64encode(raw).decode()
+
+
+def load_x25519_public_key(b64_data):
+    return x25519.X25519PublicKey.from_public_bytes(base64.b64decode(b64_data))
+
+
+def ed25519_sign(private_key, message: bytes) -> bytes:
+    return private_key.sign(message)
+
+
+def x25519_derive_key(private_key, peer_public_key, salt: bytes, info: bytes):
+    """X25519 密钥协商 + HKDF-SHA256，得到 32 字节 AES-GCM key"""
+    shared = private_key.exchange(peer_public_key)
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(
+        shared
+    )
+
+
+def derive_session_key(private_key, peer_public_key, salt: bytes, id_a, id_b):
+    """两个用户之间的 v2 会话密钥，info 绑定双方 id（与方向无关）"""
+    low, high = sorted((int(id_a), int(id_b)))
+    info = f"encommunication-v2|{low}|{high}".encode()
+    return x25519_derive_key(private_key, peer_public_key, salt, info)
+
+
 # === symmetric encryption ===#
 
 
@@ -89,21 +154,27 @@ def gen_sym_key():
     return os.urandom(32)  # 32 bytes = 256 bits
 
 
-def aes_gcm_encrypt(key: bytes, plaintext: bytes):
-    # 生成随机 12 字节的 IV（推荐长度）
+def aes_gcm_encrypt(key: bytes, plaintext: bytes, aad: bytes = None):
+    # 生成随机 12 字节的 IV（推荐长度）；不允许调用方指定，避免同一密钥下 IV 重复
     iv = os.urandom(12)
     encryptor = Cipher(
         algorithms.AES(key), modes.GCM(iv), backend=default_backend()
     ).encryptor()
+    if aad:
+        encryptor.authenticate_additional_data(aad)  # 附加认证数据：不加密但受标签保护
     ciphertext = encryptor.update(plaintext) + encryptor.finalize()
     tag = encryptor.tag  # 认证标签（防篡改）
     return iv, ciphertext, tag
 
 
-def aes_gcm_decrypt(key: bytes, iv: bytes, ciphertext: bytes, tag: bytes):
+def aes_gcm_decrypt(
+    key: bytes, iv: bytes, ciphertext: bytes, tag: bytes, aad: bytes = None
+):
     decryptor = Cipher(
         algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend()
     ).decryptor()
+    if aad:
+        decryptor.authenticate_additional_data(aad)
     plaintext = decryptor.update(ciphertext) + decryptor.finalize()
     return plaintext
 
@@ -159,3 +230,21 @@ def load_or_generate_keys(username):
             f.write(serialize_public_key(public_key))
 
     return private_key, public_key
+
+
+def load_or_generate_ecdh_keys(username):
+    """加载或生成用户的 X25519 密钥对（协议 v2）"""
+    os.makedirs("./keys", exist_ok=True)
+
+    priv_path = f"./keys/{username}_x25519_priv.pem"
+    pub_path = f"./keys/{username}_x25519_pub.pem"
+
+    if os.path.exists(priv_path) and os.path.exists(pub_path):
+        with open(priv_path, "r") as f:
+            private_key = load_private_key(f.read())
+        public_key = private_key.public_key()
+    else:
+        private_key, public_key = generate_x25519_keys()
+        save_keypair(private_key, public_key, priv_path, pub_path)
+
+    return private_key, public_key
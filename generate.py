@@ -1,6 +1,18 @@
-from crypto_utils import generate_rsa_keys, serialize_private_key, serialize_public_key
+import sys
 
-private_key, public_key = generate_rsa_keys()
+from crypto_utils import (
+    generate_rsa_keys,
+    generate_ed25519_keys,
+    serialize_private_key,
+    serialize_public_key,
+)
+
+# python generate.py          -> RSA-2048 服务器密钥
+# python generate.py ed25519  -> Ed25519 服务器密钥（密钥和签名更短；校验比 RSA-2048 慢，见 bench.py）
+if len(sys.argv) > 1 and sys.argv[1] == "ed25519":
+    private_key, public_key = generate_ed25519_keys()
+else:
+    private_key, public_key = generate_rsa_keys()
 
 # 转为 PEM 格式字符串
 pub_pem = serialize_public_key(public_key)
@@ -13,4 +25,4 @@ with open("server_public.pem", "w") as f:
 with open("server_private.pem", "w") as f:
     f.write(priv_pem)
 
-print("✅ 服务器RSA密钥对已生成")
+print("✅ 服务器密钥对已生成")
@@ -0,0 +1,89 @@
+import base64
+
+from crypto_utils import gen_sym_key, rsa_encrypt, load_public_key
+
+BROADCAST_GROUP = "broadcast"  # 广播给所有在线用户时使用的保留群组 id
+
+
+class GroupSession:
+    """群组会话：消息只用群组内容密钥加密一次，密钥按成员分别用 RSA 公钥包装
+
+    - 包装结果按 (成员, 公钥) 缓存，同一密钥周期内每个成员只做一次 RSA 公钥运算
+    - 成员加入或离开都会轮换密钥（epoch + 1）：新成员无法解密加入前的消息，
+      离开者无法解密之后的消息；当前密钥还没有发给任何人时不需要轮换
+    """
+
+    def __init__(self, group_id, members=()):
+        self.group_id = group_id
+        self.members = set()
+        self.epoch = 0
+        self.key = gen_sym_key()
+        self._wrapped = {}  # member_id -> (公钥 PEM, base64 包装后的密钥)
+        self._distributed = False  # 当前密钥是否已经（或即将）用于发送
+        self.add_members(members)
+
+    def add_members(self, member_ids):
+        """新成员加入后轮换密钥，新成员只能拿到加入之后的密钥"""
+        added = set(member_ids) - self.members
+        if added:
+            self.members |= added
+            self._rekey_if_distributed()
+        return added
+
+    def remove_members(self, member_ids):
+        """成员离开后轮换密钥，已缓存的包装结果全部作废"""
+        removed = self.members & set(member_ids)
+        if removed:
+            self.members -= removed
+            self._rekey_if_distributed()
+        return removed
+
+    def set_members(self, member_ids):
+        """整体同步成员列表（用于广播组跟随在线用户变化）"""
+        member_ids = set(member_ids)
+        self.remove_members(self.members - member_ids)
+        return self.add_members(member_ids)
+
+    def rekey(self):
+        self.epoch += 1
+        self.key = gen_sym_key()
+        self._wrapped.clear()
+        self._distributed = False
+
+    def mark_distributed(self):
+        """发送方取走当前密钥（之后在锁外加密、包装）时调用，之后的成员变化都会轮换密钥"""
+        self._distributed = True
+
+    def _rekey_if_distributed(self):
+        # 没有发出过的密钥不可能被任何人拿到，连续的成员变化只轮换一次
+        if self._distributed:
+            self.rekey()
+
+    def cached_wrap(self, member_id, pub_pem):
+        """当前密钥为某成员包装过的结果，没有时返回 None"""
+        cached = self._wrapped.get(member_id)
+        if cached is not None and cached[0] == pub_pem:
+            return cached[1]
+        return None
+
+    def store_wrap(self, epoch, member_id, pub_pem, enc_key):
+        """保存 wrap_key 的结果；期间密钥已轮换时丢弃，返回是否保存"""
+        if epoch != self.epoch:
+            return False
+        self._wrapped[member_id] = (pub_pem, enc_key)
+        self._distributed = True
+        return True
+
+    @staticmethod
+    def wrap_key(key, pub_pem):
+        """用成员公钥包装群组密钥（RSA 公钥运算，不访问会话状态，可在锁外执行）"""
+        pub = load_public_key(pub_pem) if isinstance(pub_pem, str) else pub_pem
+        return base64.b64encode(rsa_encrypt(pub, key)).decode()
+
+    def wrapped_key(self, member_id, pub_pem):
+        """返回当前密钥为某成员包装后的 base64 字符串（带缓存）"""
+        enc_key = self.cached_wrap(member_id, pub_pem)
+        if enc_key is None:
+            enc_key = self.wrap_key(self.key, pub_pem)
+            self.store_wrap(self.epoch, member_id, pub_pem, enc_key)
+        return enc_key
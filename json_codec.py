@@ -0,0 +1,32 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# 与标准库行为保持一致：int 等非字符串键转成字符串
+_ORJSON_OPTS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def dumpb(obj):
+    """对象 -> UTF-8 编码的紧凑 JSON 字节（HTTP 响应、SSE 事件）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=_ORJSON_OPTS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def dumps(obj):
+    """对象 -> JSON 字符串（WebSocket 文本帧）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=_ORJSON_OPTS).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data):
+    """str / bytes -> 对象；格式错误时抛出 ValueError（两种实现的异常都是其子类）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -1,25 +1,77 @@
 import webbrowser
 from flask import Flask, render_template, request, jsonify, Response
+from flask.json.provider import JSONProvider
 from ws_client import WSClient, online_users
 import requests
 from crypto_utils import (
     load_or_generate_keys,
+    load_or_generate_ecdh_keys,
     serialize_public_key,
-    rsa_decrypt,
+    serialize_raw_public_key,
     aes_gcm_decrypt,
 )
+from search_index import message_key
+from compression import decode_payload
+from sequencing import seq_aad, unpack_seq
+from rate_limit import RateLimiter, ConcurrencyLimiter
+from sessions import SessionRegistry
+from profiling import SamplingProfiler, LoopLagMonitor, dump_task_stacks
+from sse import EventBroadcaster
+import json_codec
+from cryptography.exceptions import InvalidTag
 import base64
-import queue
+import functools
+import hmac
+import math
 import time
 
+
+class CodecJSONProvider(JSONProvider):
+    """让 jsonify / request.json / 返回 dict 都走 json_codec（装了 orjson 时更快）"""
+
+    def dumps(self, obj, **kwargs):
+        return json_codec.dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return json_codec.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            json_codec.dumpb(obj), mimetype="application/json"
+        )
+
+
 app = Flask(__name__)
+app.json = CodecJSONProvider(app)
 host = "127.0.0.1"
 port = 5000
-message_queue = queue.Queue()
-ws_clients = {}  # id -> WSClient实例
+events = EventBroadcaster()  # SSE 订阅者
 server_address = "172.16.2.82:8080"
 CHAT_RECORDS_FILE = "chat_records.json"
 
+# 限流配置：endpoint -> [每秒请求数, 突发上限]，未列出的接口不限流
+# 可用环境变量覆盖，例如 FLASK_RATE_LIMITS__chat_records='[0.5, 2]'
+app.config["RATE_LIMITS"] = {
+    "send_message": [20, 40],
+    "group_send": [5, 10],
+    "chat_records": [1, 5],
+    "search": [10, 20],
+}
+app.config["CRYPTO_CONCURRENCY"] = 4  # 全局同时进行的历史记录解密/群发请求数
+app.config["MAX_QUEUED_MESSAGES"] = 200  # 每个会话等待密钥交换的消息上限
+app.config["SESSION_IDLE_TIMEOUT"] = 2 * 60 * 60  # 秒，0 表示不清理空闲会话
+# 调试接口（/api/debug/*）的访问令牌；未设置时调试接口返回 404
+# 例如 FLASK_DEBUG_TOKEN=$(openssl rand -hex 16) python main.py
+app.config["DEBUG_TOKEN"] = None
+app.config.from_prefixed_env()
+
+ws_clients = SessionRegistry(app.config["SESSION_IDLE_TIMEOUT"])  # id -> WSClient实例
+
+rate_limiter = RateLimiter(app.config["RATE_LIMITS"])
+crypto_limiter = ConcurrencyLimiter(app.config["CRYPTO_CONCURRENCY"])
+profiler = SamplingProfiler()
+
 
 def _make_resp(code: int, msg: str, data=None, status_code: int = 200):
     """统一返回格式：{ code: 1|0, msg: str, data: ... } 以及 HTTP 状态码
@@ -30,6 +82,102 @@ def _make_resp(code: int, msg: str, data=None, status_code: int = 200):
     return jsonify(payload), status_code
 
 
+def _too_many_requests(retry_after):
+    resp, status_code = _make_resp(0, "请求过于频繁，请稍后重试", None, 429)
+    resp.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return resp, status_code
+
+
+def _token_matches(client, token):
+    return bool(token and client.token) and hmac.compare_digest(
+        token.encode(), str(client.token).encode()
+    )
+
+
+def _rate_limit_key():
+    """限流使用的标识，返回 (key, 错误响应)
+
+    请求中的用户 id 本身不可信，只凭 id 限流会让任何人都能耗尽别人的额度；而前端都经本机
+    转发（127.0.0.1），按地址限流又会让所有用户共用一个额度。所以请求的用户有登录会话时
+    必须带上该会话的 token（请求头 token），否则返回 403，通过后按用户限流；没有会话的
+    请求（接口本身会返回 400）按客户端地址限流
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    user_id = (
+        data.get("from_id") or request.args.get("fromId") or request.args.get("userId")
+    )
+    try:
+        client = ws_clients.get(int(user_id), touch=False)
+    except (TypeError, ValueError):
+        client = None
+    if client is None:
+        return f"addr:{request.remote_addr}", None
+    if not _token_matches(client, request.headers.get("token")):
+        return None, _make_resp(0, "token 不匹配", None, 403)
+    return f"user:{int(user_id)}", None
+
+
+def rate_limited(endpoint, expensive=False):
+    """校验 token 后按用户和接口限流；expensive 的接口还要占用全局加解密并发名额，超限返回 429"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key, error = _rate_limit_key()
+            if error is not None:
+                return error
+            retry_after = rate_limiter.check(key, endpoint)
+            if retry_after:
+                return _too_many_requests(retry_after)
+            if not expensive:
+                return fn(*args, **kwargs)
+
+            if not crypto_limiter.try_acquire():
+                return _too_many_requests(1)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                crypto_limiter.release()
+
+        return wrapper
+
+    return decorator
+
+
+def debug_only(fn):
+    """调试接口：未配置 DEBUG_TOKEN 时不存在（404），请求头 X-Debug-Token 不匹配返回 403"""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        expected = app.config.get("DEBUG_TOKEN")
+        if not expected:
+            return _make_resp(0, "Not Found", None, 404)
+        supplied = request.headers.get("X-Debug-Token", "")
+        if not hmac.compare_digest(supplied.encode(), str(expected).encode()):
+            return _make_resp(0, "调试令牌错误", None, 403)
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def _debug_clients():
+    """userId 参数指定的会话，未指定时为全部会话"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    user_id = request.args.get("userId") or data.get("user_id")
+    if user_id is None:
+        return ws_clients.items()
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return []
+    client = ws_clients.get(user_id, touch=False)
+    return [(user_id, client)] if client is not None else []
+
+
 # ------------------------------
 # 页面路由
 # ------------------------------
@@ -76,10 +224,12 @@ def login():
                 token = user_data.get("token")
                 username = user_data.get("username")
                 client = WSClient(user_id, username, token, host, port)
-                ws_clients[user_id] = client
+                client.max_queued = app.config["MAX_QUEUED_MESSAGES"]
+                # 同一用户重复登录时会先关闭旧会话
+                ws_clients.register(user_id, client)
                 client.start()
 
-                return _make_resp(1, "登录成功", {"token": token})
+                return _make_resp(1, "登录成功", {"userId": user_id, "token": token})
             else:
                 return _make_resp(0, "后端未返回有效的 code", backend_data, 400)
         else:
@@ -95,6 +245,28 @@ def login():
         return _make_resp(0, f"服务器错误: {str(e)}", None, 500)
 
 
+@app.route("/api/logout", methods=["POST"])
+def logout():
+    """注销会话：关闭 WebSocket 连接、结束线程并释放密钥状态"""
+    data = request.json
+    if not data:
+        return _make_resp(0, "No JSON data", None, 400)
+
+    try:
+        user_id = int(data["user_id"])
+    except (KeyError, ValueError, TypeError):
+        return _make_resp(0, "Invalid user_id", None, 400)
+
+    client = ws_clients.get(user_id, touch=False)
+    if client is None:
+        return _make_resp(0, "no client", None, 400)
+    if not _token_matches(client, request.headers.get("token")):
+        return _make_resp(0, "token 不匹配", None, 403)
+
+    ws_clients.remove(user_id)
+    return _make_resp(1, "已注销", None)
+
+
 @app.route("/api/register", methods=["POST"])
 def register():
     try:
@@ -108,6 +280,7 @@ def register():
             return jsonify({"code": 0, "msg": "缺少必要参数", "data": None}), 400
 
         priv_key, pub_key = load_or_generate_keys(username)
+        ecdh_priv, ecdh_pub = load_or_generate_ecdh_keys(username)
 
         backend_url = f"http://{server_address}/register"
         payload = {
@@ -115,6 +288,7 @@ def register():
             "password": password,
             "repassword": repassword,
             "publicKey": serialize_public_key(pub_key),
+            "ecdhKey": serialize_raw_public_key(ecdh_pub),
         }
         # print(payload)
         response = requests.post(
@@ -144,24 +318,45 @@ def get_online_users():
 def push_message():
     """WebSocket 或内部调用，把消息推送给浏览器"""
     data = request.json
-    message_queue.put(data)
+    events.publish(data)
     print(f"[推送消息] {data}")
     return {"status": "ok"}
 
 
 @app.route("/api/stream")
 def stream():
-    """SSE 数据流：浏览器通过 EventSource 订阅"""
+    """SSE 数据流：浏览器通过 EventSource 订阅，每个连接都会收到全部推送
 
-    def event_stream():
-        while True:
-            msg = message_queue.get()  # 阻塞等待消息
-            yield f"data: {msg}\n\n"  # SSE 格式：每条消息以 \n\n 结尾
+    带上 ?userId=&token= 时，连接保持期间该用户的会话不会因空闲被清理
+    （EventSource 不能设置请求头，只能通过查询参数传递 token）
+    """
+    on_keepalive = None
+    user_id = request.args.get("userId", type=int)
+    token = request.args.get("token")
+    if user_id is not None and token:
+        client = ws_clients.get(user_id)
+        if client is None:
+            return _make_resp(0, "no client", None, 400)
+        if not _token_matches(client, token):
+            return _make_resp(0, "token 不匹配", None, 403)
+
+        def on_keepalive():
+            ws_clients.touch(user_id)
+
+    # 浏览器断线重连时自动带上 Last-Event-ID 请求头，补发断开期间的事件
+    try:
+        last_event_id = int(request.headers["Last-Event-ID"])
+    except (KeyError, ValueError):
+        last_event_id = None
 
-    return Response(event_stream(), content_type="text/event-stream")
+    # 每条事件为 "id: <n>\ndata: <JSON>\n\n"，已在 publish 时编码好
+    return Response(
+        events.stream(last_event_id, on_keepalive), content_type="text/event-stream"
+    )
 
 
 @app.route("/api/send_message", methods=["POST"])
+@rate_limited("send_message")
 def send_message():
     data = request.json
     if not data:
@@ -176,6 +371,9 @@ def send_message():
 
     client = ws_clients.get(from_id)
     if client:
+        if client.queue_full(target_id):
+            return _too_many_requests(1)
+
         if not client.connected:
             print("[Flask] 等待 WebSocket 连接...")
             client.start()
@@ -189,7 +387,159 @@ def send_message():
     return _make_resp(0, "no client", None, 400)
 
 
+@app.route("/api/group/create", methods=["POST"])
+def create_group():
+    data = request.json
+    if not data:
+        return _make_resp(0, "No JSON data", None, 400)
+
+    try:
+        from_id = int(data["from_id"])
+        group_id = str(data["group_id"])
+        members = [int(m) for m in data["members"]]
+    except (KeyError, ValueError, TypeError):
+        return _make_resp(0, "Invalid group format", None, 400)
+
+    client = ws_clients.get(from_id)
+    if not client:
+        return _make_resp(0, "no client", None, 400)
+
+    group = client.create_group(group_id, members)
+    return _make_resp(1, "ok", {"group_id": group_id, "members": sorted(group.members)})
+
+
+@app.route("/api/group/members", methods=["POST"])
+def update_group_members():
+    data = request.json
+    if not data:
+        return _make_resp(0, "No JSON data", None, 400)
+
+    try:
+        from_id = int(data["from_id"])
+        group_id = str(data["group_id"])
+        add = [int(m) for m in data.get("add", [])]
+        remove = [int(m) for m in data.get("remove", [])]
+    except (KeyError, ValueError, TypeError):
+        return _make_resp(0, "Invalid group format", None, 400)
+
+    client = ws_clients.get(from_id)
+    if not client:
+        return _make_resp(0, "no client", None, 400)
+
+    group = client.update_group_members(group_id, add, remove)
+    if group is None:
+        return _make_resp(0, "Group not found", None, 400)
+    return _make_resp(
+        1,
+        "ok",
+        {"group_id": group_id, "members": sorted(group.members), "epoch": group.epoch},
+    )
+
+
+@app.route("/api/group/send", methods=["POST"])
+@rate_limited("group_send", expensive=True)
+def send_group_message():
+    data = request.json
+    if not data:
+        return _make_resp(0, "No JSON data", None, 400)
+
+    try:
+        from_id = int(data["from_id"])
+        group_id = str(data["group_id"])
+        message = data["message"]
+    except (KeyError, ValueError, TypeError):
+        return _make_resp(0, "Invalid message format", None, 400)
+
+    client = ws_clients.get(from_id)
+    if not client:
+        return _make_resp(0, "no client", None, 400)
+
+    if client.send_group_message(group_id, message):
+        return _make_resp(1, "ok", None)
+    return _make_resp(0, "发送失败: 客户端未就绪或群组不存在", None, 500)
+
+
+@app.route("/api/broadcast", methods=["POST"])
+@rate_limited("group_send", expensive=True)
+def broadcast_message():
+    data = request.json
+    if not data:
+        return _make_resp(0, "No JSON data", None, 400)
+
+    try:
+        from_id = int(data["from_id"])
+        message = data["message"]
+    except (KeyError, ValueError, TypeError):
+        return _make_resp(0, "Invalid message format", None, 400)
+
+    client = ws_clients.get(from_id)
+    if not client:
+        return _make_resp(0, "no client", None, 400)
+
+    if client.broadcast_message(message):
+        return _make_resp(1, "ok", None)
+    return _make_resp(0, "发送失败: 客户端未就绪", None, 500)
+
+
+def _decrypt_chat_records(client, records, from_id, to_id):
+    """解密后端返回的聊天记录，返回 (接口返回的记录, 待写入搜索索引的记录)"""
+    records_ret = []
+    to_index = []
+
+    for record in records:
+        try:
+            create_time = record.get("createTime")
+            en_msg = record.get("message", "")
+
+            if from_id == record.get("fromId"):
+                aes_key = record.get("toAesKey", "")
+                peer_id = record.get("toId")
+            else:
+                aes_key = record.get("fromAesKey", "")
+                peer_id = record.get("fromId")
+            # 同一会话的记录共用 aesKey，解包结果在客户端内缓存
+            K = client.unwrap_session_key(peer_id, aes_key)
+            enc_bytes = base64.b64decode(en_msg)
+            iv, ct, tag = enc_bytes[:12], enc_bytes[12:-16], enc_bytes[-16:]
+            try:
+                data = aes_gcm_decrypt(K, iv, ct, tag)
+            except InvalidTag:
+                # 带序号的消息绑定了收发双方，按发送时的附加认证数据重试
+                aad = seq_aad(record.get("fromId"), record.get("toId"))
+                data = aes_gcm_decrypt(K, iv, ct, tag, aad)
+            plaintext = decode_payload(unpack_seq(data)[1])
+
+            records_ret.append(
+                {
+                    "id": record.get("id"),
+                    "fromId": record.get("fromId"),
+                    "toId": record.get("toId"),
+                    "chat": plaintext,
+                    "createTime": create_time,
+                }
+            )
+            to_index.append(
+                (
+                    message_key(en_msg),
+                    {
+                        "peerId": to_id,
+                        "fromId": record.get("fromId"),
+                        "toId": record.get("toId"),
+                        "groupId": None,
+                        "content": plaintext,
+                        "createTime": create_time,
+                    },
+                )
+            )
+        except Exception as e:
+            # 单条记录处理失败时继续处理其他记录
+            print(f"[记录处理错误] {e}")
+
+    return records_ret, to_index
+
+
 @app.route("/api/chat/records", methods=["GET"])
+@rate_limited("chat_records")
 def get_chat_records():
     backend_url = f"http://{server_address}/chatRecords"
     try:
@@ -208,7 +558,8 @@ def get_chat_records():
             return jsonify({"code": 0, "msg": "Invalid ID format", "data": None}), 400
 
         # 验证客户端存在
-        if from_id not in ws_clients:
+        client = ws_clients.get(from_id)
+        if client is None:
             return jsonify({"code": 0, "msg": "Sender not found", "data": None}), 400
 
         # 加载记录
@@ -216,42 +567,29 @@ def get_chat_records():
         response = requests.get(
             backend_url,
             params=payload,
-            headers={"token": ws_clients[from_id].token},
+            headers={"token": client.token},
         )
         if response.status_code == 200:
-            records = response.json()
+            records = json_codec.loads(response.content)
             print(records)
 
-            records_ret = []
-
-            for record in records:
+            # 只在解密期间占用全局加解密名额，后端请求慢时不影响其他请求
+            if not crypto_limiter.try_acquire():
+                return _too_many_requests(1)
+            try:
+                records_ret, to_index = _decrypt_chat_records(
+                    client, records, from_id, to_id
+                )
+            finally:
+                crypto_limiter.release()
+
+            # 顺带写入本地搜索索引，已索引过的消息按密文去重
+            search_index = client.search_index
+            if search_index is not None and to_index:
                 try:
-                    create_time = record.get("createTime")
-                    en_msg = record.get("message", "")
-
-                    if from_id == record.get("fromId"):
-                        aes_key = record.get("toAesKey", "")
-                    else:
-                        aes_key = record.get("fromAesKey", "")
-                    K = rsa_decrypt(
-                        ws_clients[from_id].priv_key, base64.b64decode(aes_key)
-                    )
-                    enc_bytes = base64.b64decode(en_msg)
-                    iv, ct, tag = enc_bytes[:12], enc_bytes[12:-16], enc_bytes[-16:]
-                    plaintext = aes_gcm_decrypt(K, iv, ct, tag).decode()
-
-                    records_ret.append(
-                        {
-                            "id": record.get("id"),
-                            "fromId": record.get("fromId"),
-                            "toId": record.get("toId"),
-                            "chat": plaintext,
-                            "createTime": create_time,
-                        }
-                    )
+                    search_index.add_many(to_index)
                 except Exception as e:
-                    # 单条记录处理失败时继续处理其他记录
-                    print(f"[记录处理错误] {e}")
+                    print(f"[搜索索引错误] {e}")
 
             return _make_resp(1, "ok", {"records": records_ret})
         else:
@@ -261,6 +599,124 @@ def get_chat_records():
         return jsonify({"code": 0, "msg": str(e), "data": None}), 500
 
 
+@app.route("/api/search", methods=["GET"])
+@rate_limited("search")
+def search_messages():
+    """在本地索引中搜索聊天记录，不访问后端"""
+    try:
+        user_id = int(request.args.get("userId", ""))
+        limit = int(request.args.get("limit", 20))
+    except (ValueError, TypeError):
+        return _make_resp(0, "Invalid userId or limit", None, 400)
+
+    query = request.args.get("q", "").strip()
+    if not query:
+        return _make_resp(0, "Missing q", None, 400)
+    peer_id = request.args.get("peerId") or None
+
+    client = ws_clients.get(user_id)
+    if not client:
+        return _make_resp(0, "no client", None, 400)
+    # 返回的是解密后的聊天记录：与 /api/logout 一样只认本人会话的 token
+    if not _token_matches(client, request.headers.get("token")):
+        return _make_resp(0, "token 不匹配", None, 403)
+    if client.search_index is None:
+        return _make_resp(0, "搜索索引不可用", None, 500)
+
+    hits = client.search_index.search(query, peer_id, limit)
+    return _make_resp(1, "ok", {"hits": hits})
+
+
+# ------------------------------
+# 调试接口（需要 DEBUG_TOKEN）
+# ------------------------------
+@app.route("/api/debug/profile/start", methods=["POST"])
+@debug_only
+def debug_profile_start():
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get("seconds", 10))
+        interval_ms = float(data.get("intervalMs", profiler.interval * 1000))
+    except (TypeError, ValueError):
+        return _make_resp(0, "Invalid seconds/intervalMs", None, 400)
+    if seconds <= 0 or interval_ms < 1:
+        return _make_resp(0, "Invalid seconds/intervalMs", None, 400)
+
+    if not profiler.start(seconds, interval_ms / 1000):
+        return _make_resp(0, "采样正在进行", profiler.status(), 409)
+    return _make_resp(1, "ok", profiler.status())
+
+
+@app.route("/api/debug/profile/stop", methods=["POST"])
+@debug_only
+def debug_profile_stop():
+    profiler.stop()
+    return _make_resp(1, "ok", profiler.status())
+
+
+@app.route("/api/debug/profile", methods=["GET"])
+@debug_only
+def debug_profile():
+    """最近一次采样结果：默认 folded 文本（flamegraph.pl / speedscope 可直接读取），format=json 时返回状态"""
+    if request.args.get("format") == "json":
+        return _make_resp(1, "ok", profiler.status())
+    return Response(profiler.folded(), content_type="text/plain; charset=utf-8")
+
+
+@app.route("/api/debug/tasks", methods=["GET"])
+@debug_only
+def debug_tasks():
+    result = {}
+    for user_id, client in _debug_clients():
+        result[str(user_id)] = dump_task_stacks(client.loop, client.loop_thread_id)
+    return _make_resp(1, "ok", result)
+
+
+@app.route("/api/debug/loop_lag/start", methods=["POST"])
+@debug_only
+def debug_loop_lag_start():
+    data = request.get_json(silent=True) or {}
+    try:
+        slow_ms = float(data.get("slowMs", 100))
+    except (TypeError, ValueError):
+        return _make_resp(0, "Invalid slowMs", None, 400)
+    if slow_ms <= 0:
+        return _make_resp(0, "Invalid slowMs", None, 400)
+
+    started = []
+    for user_id, client in _debug_clients():
+        if client.lag_monitor is not None and client.lag_monitor.running:
+            continue
+        monitor = LoopLagMonitor(
+            client.loop, client.loop_thread_id, slow_threshold=slow_ms / 1000
+        )
+        if monitor.start():
+            client.lag_monitor = monitor
+            started.append(user_id)
+    return _make_resp(1, "ok", {"started": started})
+
+
+@app.route("/api/debug/loop_lag/stop", methods=["POST"])
+@debug_only
+def debug_loop_lag_stop():
+    stopped = []
+    for user_id, client in _debug_clients():
+        if client.lag_monitor is not None:
+            client.lag_monitor.stop()
+            stopped.append(user_id)
+    return _make_resp(1, "ok", {"stopped": stopped})
+
+
+@app.route("/api/debug/loop_lag", methods=["GET"])
+@debug_only
+def debug_loop_lag():
+    result = {}
+    for user_id, client in _debug_clients():
+        if client.lag_monitor is not None:
+            result[str(user_id)] = client.lag_monitor.report()
+    return _make_resp(1, "ok", result)
+
+
 if __name__ == "__main__":
     # 启动浏览器访问
     # webbrowser.open("http://127.0.0.1:5000")
@@ -0,0 +1,271 @@
+import asyncio
+import io
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+SAMPLE_INTERVAL = 0.005  # 采样间隔（秒）
+MAX_PROFILE_SECONDS = 60  # 单次采样的最长时间
+LAG_INTERVAL = 0.1  # 事件循环心跳间隔（秒）
+SLOW_CALLBACK = 0.1  # 心跳超过该秒数未执行视为有回调阻塞了事件循环
+MAX_SLOW_EVENTS = 50  # 每个循环最多保留的慢回调记录
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{code.co_name}:{frame.f_lineno}"
+
+
+def _folded_stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _format_frame_stack(frame):
+    return "".join(traceback.format_stack(frame))
+
+
+class SamplingProfiler:
+    """采样分析器：后台线程定期读取所有线程的调用栈（sys._current_frames），
+    输出 folded 格式（"线程;帧;帧 次数"），可直接交给 flamegraph.pl / speedscope。
+
+    只在 start() 到 stop() 之间有开销，不修改任何被分析的代码。
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._counts = Counter()
+        self._samples = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.started_at = None
+        self.stopped_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration=None, interval=None):
+        """开始采样；duration 秒后自动停止（上限 MAX_PROFILE_SECONDS）
+
+        interval 为本次及之后的采样间隔；正在采样时返回 False，不修改任何设置
+        """
+        with self._lock:
+            if self.running:
+                return False
+            duration = min(duration or MAX_PROFILE_SECONDS, MAX_PROFILE_SECONDS)
+            if interval is not None:
+                self.interval = interval
+            self._counts = Counter()
+            self._samples = 0
+            self._stop.clear()
+            self.started_at = time.time()
+            self.stopped_at = None
+            self._thread = threading.Thread(
+                target=self._sample_loop, args=(duration,), daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+    def _sample_loop(self, duration):
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [names.get(ident, str(ident))] + _folded_stack(frame)
+                self._counts[";".join(stack)] += 1
+            self._samples += 1
+            self._stop.wait(self.interval)
+        self.stopped_at = time.time()
+
+    def folded(self):
+        """folded 格式文本，每行一个调用栈及其采样次数"""
+        counts = self._counts.copy()
+        return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+    def status(self):
+        return {
+            "running": self.running,
+            "samples": self._samples,
+            "stacks": len(self._counts),
+            "intervalMs": self.interval * 1000,
+            "startedAt": self.started_at,
+            "stoppedAt": self.stopped_at,
+        }
+
+
+def dump_task_stacks(loop, thread_id=None, timeout=2.0):
+    """导出事件循环上所有 asyncio 任务的调用栈
+
+    在循环线程内收集，保证读取任务状态时不会与循环并发修改；循环被阻塞时超时，
+    此时至少返回循环线程当前正在执行的调用栈，便于定位阻塞点。
+    """
+    result = {"tasks": [], "blocked": False, "threadStack": None}
+    if thread_id is not None:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            result["threadStack"] = _format_frame_stack(frame)
+
+    if loop is None or loop.is_closed() or not loop.is_running():
+        return result
+
+    async def collect():
+        tasks = []
+        for task in asyncio.all_tasks():
+            buf = io.StringIO()
+            task.print_stack(file=buf)
+            tasks.append(
+                {
+                    "name": task.get_name(),
+                    "coro": getattr(
+                        task.get_coro(), "__qualname__", repr(task.get_coro())
+                    ),
+                    "done": task.done(),
+                    "stack": buf.getvalue(),
+                }
+            )
+        return tasks
+
+    future = asyncio.run_coroutine_threadsafe(collect(), loop)
+    try:
+        result["tasks"] = future.result(timeout)
+    except Exception:
+        future.cancel()
+        result["blocked"] = True
+    return result
+
+
+class LoopLagMonitor:
+    """事件循环延迟监控 + 慢回调检测
+
+    循环内每 interval 秒执行一次心跳并记录实际延迟；看门狗线程发现心跳超过
+    slow_threshold 秒没有执行时，抓取循环线程当前的调用栈，即正在阻塞循环的回调。
+    未启动时不会在循环上调度任何东西。
+    """
+
+    def __init__(
+        self,
+        loop,
+        thread_id,
+        interval=LAG_INTERVAL,
+        slow_threshold=SLOW_CALLBACK,
+        max_events=MAX_SLOW_EVENTS,
+    ):
+        self.loop = loop
+        self.thread_id = thread_id
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.lags = deque(maxlen=1000)
+        self.slow_events = deque(maxlen=max_events)
+        self._beat = time.monotonic()
+        self._expected = None
+        self._handle = None
+        self._stop = threading.Event()
+        self._watchdog = None
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._watchdog is not None and self._watchdog.is_alive()
+
+    def start(self):
+        if self.running or self.loop is None or self.loop.is_closed():
+            return False
+        self._stop.clear()
+        self.started_at = time.time()
+        self._beat = time.monotonic()
+        self.loop.call_soon_threadsafe(self._schedule)
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._cancel)
+            except RuntimeError:
+                pass
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        if self._stop.is_set():
+            return
+        self._expected = time.monotonic() + self.interval
+        self._handle = self.loop.call_later(self.interval, self._heartbeat)
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        self.lags.append(max(0.0, now - self._expected))
+        self._beat = now
+        self._schedule()
+
+    def _watch(self):
+        reported = None  # 同一次阻塞只记录一次
+        while not self._stop.wait(self.slow_threshold / 2):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.slow_threshold:
+                if reported is not None:
+                    reported["durationMs"] = round(
+                        (self._beat - reported["_start"]) * 1000, 1
+                    )
+                    reported = None
+                continue
+            if reported is not None and reported["_beat"] == beat:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            reported = {
+                "_beat": beat,
+                "_start": beat + self.interval,
+                "at": time.time(),
+                "durationMs": None,  # 阻塞结束后补上
+                "stack": _format_frame_stack(frame) if frame is not None else None,
+            }
+            self.slow_events.append(reported)
+
+    def report(self):
+        lags = sorted(self.lags)
+        events = [
+            {k: v for k, v in event.items() if not k.startswith("_")}
+            for event in list(self.slow_events)
+        ]
+        summary = {
+            "running": self.running,
+            "startedAt": self.started_at,
+            "intervalMs": self.interval * 1000,
+            "slowThresholdMs": self.slow_threshold * 1000,
+            "samples": len(lags),
+            "slowCallbacks": events,
+        }
+        if lags:
+            summary.update(
+                {
+                    "avgLagMs": round(sum(lags) / len(lags) * 1000, 2),
+                    "p99LagMs": round(lags[int(len(lags) * 0.99)] * 1000, 2),
+                    "maxLagMs": round(lags[-1] * 1000, 2),
+                }
+            )
+        return summary
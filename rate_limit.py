@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+MAX_BUCKETS = 10000  # 最多保留的令牌桶数量，超出时淘汰最久未使用的
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def try_acquire(self, now=None):
+        """拿到令牌返回 0，否则返回需要等待的秒数"""
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return 60.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """按 (用户, 接口) 分别限流，一个用户刷接口不会占用其他用户的额度
+
+    limits: endpoint -> (每秒请求数, 突发上限)；未配置的接口不限流
+    """
+
+    def __init__(self, limits, max_buckets=MAX_BUCKETS):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, user_id, endpoint):
+        """允许请求返回 0，否则返回建议的 Retry-After 秒数"""
+        limit = self.limits.get(endpoint)
+        if not limit:
+            return 0.0
+
+        key = (user_id, endpoint)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(*limit)
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.try_acquire()
+
+
+class ConcurrencyLimiter:
+    """全局限制同时进行的耗时加解密请求数；已满时直接拒绝而不是排队"""
+
+    def __init__(self, limit):
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def try_acquire(self):
+        return self._semaphore.acquire(blocking=False)
+
+    def release(self):
+        self._semaphore.release()
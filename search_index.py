@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import json_codec
+from crypto_utils import (
+    gen_sym_key,
+    rsa_encrypt,
+    rsa_decrypt,
+    aes_gcm_encrypt,
+    aes_gcm_decrypt,
+)
+
+MAX_SEARCH_LIMIT = 100
+
+
+def message_key(ciphertext_b64):
+    """用密文计算消息去重键：实时收发与历史记录里的同一条消息密文相同"""
+    return hashlib.sha256(ciphertext_b64.encode()).hexdigest()[:32]
+
+
+def now_str():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class SearchIndex:
+    """本地聊天记录全文索引
+
+    磁盘上（keys/{username}_index.db）只保存 AES-GCM 加密后的消息，索引密钥用本人 RSA
+    公钥包装后保存在 keys/{username}_index.key。FTS5 索引只建在内存中：打开时解密重建，
+    之后随收发消息和历史记录加载增量更新，搜索不需要访问后端。
+    """
+
+    def __init__(self, username, priv_key, pub_key, directory="./keys"):
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._key = self._load_or_create_key(
+            os.path.join(directory, f"{username}_index.key"), priv_key, pub_key
+        )
+        self._known = set()  # 已索引的 msg_key
+
+        self._disk = sqlite3.connect(
+            os.path.join(directory, f"{username}_index.db"), check_same_thread=False
+        )
+        self._disk.execute(
+            "CREATE TABLE IF NOT EXISTS messages "
+            "(msg_key TEXT PRIMARY KEY, blob BLOB NOT NULL)"
+        )
+        self._disk.commit()
+
+        # trigram 分词按子串匹配，中文不分词也能搜索
+        self._mem = sqlite3.connect(":memory:", check_same_thread=False)
+        self._mem.execute(
+            "CREATE VIRTUAL TABLE fts USING fts5("
+            "content, peer_id UNINDEXED, from_id UNINDEXED, to_id UNINDEXED, "
+            "group_id UNINDEXED, create_time UNINDEXED, tokenize='trigram')"
+        )
+        self._rebuild()
+
+    @staticmethod
+    def _load_or_create_key(path, priv_key, pub_key):
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return rsa_decrypt(priv_key, base64.b64decode(f.read()))
+
+        key = gen_sym_key()
+        with open(path, "w") as f:
+            f.write(base64.b64encode(rsa_encrypt(pub_key, key)).decode())
+        return key
+
+    def _rebuild(self):
+        rows = self._disk.execute("SELECT msg_key, blob FROM messages").fetchall()
+        for msg_key, blob in rows:
+            try:
+                iv, ct, tag = blob[:12], blob[12:-16], blob[-16:]
+                record = json_codec.loads(aes_gcm_decrypt(self._key, iv, ct, tag))
+            except Exception as e:
+                print(f"[搜索索引] 记录 {msg_key} 解密失败: {e}")
+                continue
+            self._insert_mem(msg_key, record)
+        self._mem.commit()
+        print(f"[搜索索引] 已加载 {len(self._known)} 条消息")
+
+    def _insert_mem(self, msg_key, record):
+        self._known.add(msg_key)
+        self._mem.execute(
+            "INSERT INTO fts (content, peer_id, from_id, to_id, group_id, create_time) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                record["content"],
+                str(record["peerId"]),
+                record["fromId"],
+                record["toId"],
+                record.get("groupId"),
+                record.get("createTime"),
+            ),
+        )
+
+    def add_many(self, records):
+        """批量写入（一次事务）；records 为 (msg_key, record dict) 列表，已存在的跳过
+
+        record: {"peerId", "fromId", "toId", "groupId", "content", "createTime"}
+        """
+        added = 0
+        with self._lock:
+            for msg_key, record in records:
+                if msg_key in self._known:
+                    continue
+                iv, ct, tag = aes_gcm_encrypt(self._key, json_codec.dumpb(record))
+                self._disk.execute(
+                    "INSERT OR IGNORE INTO messages (msg_key, blob) VALUES (?, ?)",
+                    (msg_key, iv + ct + tag),
+                )
+                self._insert_mem(msg_key, record)
+                added += 1
+            if added:
+                self._disk.commit()
+                self._mem.commit()
+        return added
+
+    def add(
+        self, msg_key, peer_id, from_id, to_id, content, create_time=None, group_id=None
+    ):
+        record = {
+            "peerId": peer_id,
+            "fromId": from_id,
+            "toId": to_id,
+            "groupId": group_id,
+            "content": content,
+            "createTime": create_time or now_str(),
+        }
+        return self.add_many([(msg_key, record)])
+
+    def search(self, query, peer_id=None, limit=20):
+        """按 bm25 排序返回命中；少于 3 个字符时 trigram 无法匹配，退化为逐条子串查找并按时间倒序"""
+        limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+        columns = (
+            "peer_id, from_id, to_id, group_id, create_time, content, "
+            "snippet(fts, 0, '[', ']', '…', 16)"
+        )
+        params = []
+        if len(query) >= 3:
+            where = "fts MATCH ?"
+            params.append('"' + query.replace('"', '""') + '"')
+            order = "bm25(fts)"
+        else:
+            # 不用 LIKE：部分 SQLite 版本的 trigram 对短 LIKE 模式直接返回空结果
+            where = "instr(content, ?) > 0"
+            params.append(query)
+            order = "rowid DESC"
+        if peer_id is not None:
+            where += " AND peer_id = ?"
+            params.append(str(peer_id))
+        params.append(limit)
+
+        with self._lock:
+            rows = self._mem.execute(
+                f"SELECT {columns} FROM fts WHERE {where} ORDER BY {order} LIMIT ?",
+                params,
+            ).fetchall()
+
+        return [
+            {
+                "peerId": row[0],
+                "fromId": row[1],
+                "toId": row[2],
+                "groupId": row[3],
+                "createTime": row[4],
+                "chat": row[5],
+                "snippet": row[6],
+            }
+            for row in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._disk.close()
+            self._mem.close()
@@ -0,0 +1,112 @@
+import threading
+import time
+
+IDLE_TIMEOUT = 2 * 60 * 60  # 超过该秒数没有任何活动的会话会被清理，0 表示不清理
+SWEEP_INTERVAL = 60
+
+
+class SessionRegistry:
+    """登录会话注册表：user_id -> WSClient
+
+    - 同一用户重新登录时先关闭旧会话再替换，不会留下多余的连接和线程
+    - 通过 get() 访问、touch()（如 SSE 连接保持）以及客户端收到消息（client.last_activity）
+      都算作活跃，后台线程定期清理空闲会话
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, sweep_interval=SWEEP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self._clients = {}  # user_id -> WSClient
+        self._last_active = {}  # user_id -> time.monotonic()
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def register(self, user_id, client):
+        with self._lock:
+            old = self._clients.get(user_id)
+            self._clients[user_id] = client
+            self._last_active[user_id] = time.monotonic()
+            self._ensure_reaper()
+
+        if old is not None and old is not client:
+            print(f"[会话] 用户 {user_id} 重新登录，关闭旧会话")
+            old.stop()
+
+    def get(self, user_id, touch=True):
+        with self._lock:
+            client = self._clients.get(user_id)
+            if client is not None and touch:
+                self._last_active[user_id] = time.monotonic()
+            return client
+
+    def touch(self, user_id):
+        """刷新活跃时间；会话不存在时返回 False"""
+        with self._lock:
+            if user_id not in self._clients:
+                return False
+            self._last_active[user_id] = time.monotonic()
+            return True
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return user_id in self._clients
+
+    def __getitem__(self, user_id):
+        client = self.get(user_id)
+        if client is None:
+            raise KeyError(user_id)
+        return client
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+    def items(self):
+        """当前会话的快照 [(user_id, client)]，不刷新活跃时间"""
+        with self._lock:
+            return list(self._clients.items())
+
+    def remove(self, user_id):
+        """注销会话并释放其连接、线程和密钥状态"""
+        with self._lock:
+            client = self._clients.pop(user_id, None)
+            self._last_active.pop(user_id, None)
+
+        if client is None:
+            return False
+        client.stop()
+        return True
+
+    def sweep(self, now=None):
+        """清理空闲会话，返回被清理的 user_id 列表"""
+        if not self.idle_timeout:
+            return []
+        if now is None:
+            now = time.monotonic()
+
+        with self._lock:
+            idle = []
+            for user_id, last in self._last_active.items():
+                # 只在收消息的会话没有 API 调用，但仍在使用
+                client = self._clients.get(user_id)
+                last = max(last, getattr(client, "last_activity", last))
+                if now - last > self.idle_timeout:
+                    idle.append(user_id)
+        for user_id in idle:
+            print(f"[会话] 用户 {user_id} 空闲超时，注销会话")
+            self.remove(user_id)
+        return idle
+
+    def _ensure_reaper(self):
+        # 在第一次登录时才启动，调用方已持有 self._lock
+        if self._reaper is None and self.idle_timeout:
+            self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[会话] 清理空闲会话出错: {e}")
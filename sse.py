@@ -0,0 +1,99 @@
+import queue
+import threading
+from collections import deque
+
+import json_codec
+
+MAX_PENDING_EVENTS = 256  # 每个订阅者最多积压的事件数，超出时丢弃最旧的
+REPLAY_EVENTS = 256  # 保留最近的事件，供断线重连（Last-Event-ID）和新订阅者补发
+KEEPALIVE_INTERVAL = 15  # 没有事件时发送注释行的间隔（秒），防止代理断开空闲连接
+KEEPALIVE = b": keepalive\n\n"
+
+
+def encode_event(data, event_id=None):
+    """编码为一条 SSE 事件；JSON 中的换行都已转义，一行 data 即可"""
+    event = b"data: " + json_codec.dumpb(data) + b"\n\n"
+    if event_id is not None:
+        event = b"id: %d\n" % event_id + event
+    return event
+
+
+class EventBroadcaster:
+    """SSE 广播：每个 EventSource 连接一个队列，每个事件只编码一次后发给所有订阅者
+
+    每个事件带递增的 id，并保留最近 replay 条：
+    - 重连时带上 Last-Event-ID 的订阅者会补收断开期间的事件
+    - 没有任何订阅者时发布的事件（例如页面刷新的间隙）交给下一个订阅者
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_EVENTS, replay=REPLAY_EVENTS):
+        self.max_pending = max_pending
+        self._subscribers = set()
+        self._history = deque(maxlen=min(replay, max_pending))  # (id, 事件)
+        self._last_id = 0
+        self._delivered_id = 0  # 该 id 及之前的事件都已交给过订阅者
+        self._lock = threading.Lock()
+
+    def subscribe(self, last_event_id=None):
+        """订阅并补发：带 last_event_id 时补发其后的全部事件，否则只补发无人接收的"""
+        q = queue.Queue(self.max_pending)
+        with self._lock:
+            # 服务重启后 id 重新计数，浏览器带来的更大的旧 id 不可信
+            if last_event_id is None or last_event_id > self._last_id:
+                last_event_id = self._delivered_id
+            for event_id, event in self._history:
+                if event_id > last_event_id:
+                    q.put_nowait(event)
+            self._delivered_id = self._last_id
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, data):
+        """返回收到该事件的订阅者数量；没有订阅者时事件留给下一个订阅者"""
+        with self._lock:
+            self._last_id += 1
+            event = encode_event(data, self._last_id)
+            self._history.append((self._last_id, event))
+            subscribers = list(self._subscribers)
+            if subscribers:
+                self._delivered_id = self._last_id
+
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait(event)
+                    break
+                except queue.Full:
+                    # 浏览器读得慢时丢弃最旧的事件，不阻塞推送方
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+        return len(subscribers)
+
+    def stream(
+        self, last_event_id=None, on_keepalive=None, keepalive=KEEPALIVE_INTERVAL
+    ):
+        """供 Flask Response 使用的生成器；连接断开时自动取消订阅
+
+        keepalive 秒内没有事件时发送一条注释行并调用 on_keepalive()
+        """
+        q = self.subscribe(last_event_id)
+        try:
+            while True:
+                try:
+                    yield q.get(timeout=keepalive)
+                except queue.Empty:
+                    if on_keepalive is not None:
+                        on_keepalive()
+                    yield KEEPALIVE
+        finally:
+            self.unsubscribe(q)
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ws_client import WSClient
+
+
+class FakeWebSocket:
+    """记录发出的帧，代替真实的 WebSocket 连接"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(data)
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+@pytest.fixture
+def make_client(tmp_path, monkeypatch):
+    """在临时目录中创建已“连接”的 WSClient（密钥、索引都写到临时目录）"""
+    monkeypatch.chdir(tmp_path)
+    clients = []
+
+    def factory(user_id, username):
+        client = WSClient(user_id, username, f"token-{user_id}", "127.0.0.1", 5000)
+        client.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=client.loop.run_forever, daemon=True)
+        thread.start()
+        client._thread = thread
+        client.ws = FakeWebSocket()
+        client.connected = True
+        client.pushed = []
+        client._push = client.pushed.append
+        clients.append(client)
+        return client
+
+    yield factory
+
+    for client in clients:
+        loop = client.loop
+        if loop is not None and not loop.is_closed():
+            run(client, _cancel_tasks())
+            loop.call_soon_threadsafe(loop.stop)
+            client._thread.join(timeout=5)
+            loop.close()
+        client.stop()
+
+
+async def _cancel_tasks():
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run(client, coro, timeout=10):
+    """在客户端的事件循环线程中执行协程并等待结果"""
+    return asyncio.run_coroutine_threadsafe(coro, client.loop).result(timeout)
@@ -0,0 +1,51 @@
+import zlib
+
+import pytest
+
+from compression import (
+    COMPRESS_THRESHOLD,
+    choose_algorithm,
+    decode_payload,
+    encode_payload,
+    supported_algorithms,
+)
+
+
+@pytest.mark.parametrize("algorithm", supported_algorithms())
+def test_round_trip(algorithm):
+    text = "日志 log line 12345\n" * 500
+    data = encode_payload(text, algorithm)
+    assert data[0] == 0xFF
+    assert len(data) < len(text.encode())
+    assert decode_payload(data) == text
+
+
+def test_small_payloads_and_peers_without_compression_are_sent_raw():
+    assert encode_payload("hi", "zlib") == b"hi"
+    text = "x" * (COMPRESS_THRESHOLD * 2)
+    assert encode_payload(text, None) == text.encode()
+    assert decode_payload(text.encode()) == text
+
+
+def test_choose_algorithm_requires_peer_support():
+    assert choose_algorithm(set()) is None
+    assert choose_algorithm({"zlib", "seq"}) == "zlib"
+
+
+@pytest.mark.parametrize("algorithm", supported_algorithms())
+def test_decompression_bomb_is_rejected(algorithm):
+    bomb = encode_payload("a" * (2 * 1024 * 1024), algorithm)
+    assert len(bomb) < 64 * 1024
+    with pytest.raises(ValueError):
+        decode_payload(bomb, max_size=1024 * 1024)
+    assert len(decode_payload(bomb, max_size=2 * 1024 * 1024)) == 2 * 1024 * 1024
+
+
+def test_truncated_and_unknown_payloads_are_rejected():
+    data = b"\xff\x01" + zlib.compress(b"x" * 4096)
+    with pytest.raises(ValueError):
+        decode_payload(data[:-8])
+    with pytest.raises(ValueError):
+        decode_payload(b"\xff\x09abc")
+    with pytest.raises(ValueError):
+        decode_payload(b"\xff")
@@ -0,0 +1,105 @@
+import base64
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+import json_codec
+import ws_client
+from conftest import run, wait_until
+from crypto_utils import aes_gcm_decrypt, generate_rsa_keys, serialize_public_key
+from group_session import BROADCAST_GROUP, GroupSession
+
+
+@pytest.fixture(scope="module")
+def member_pem():
+    return serialize_public_key(generate_rsa_keys()[1])
+
+
+def test_rekey_on_join_and_leave_only_after_distribution(member_pem):
+    group = GroupSession("g", {2, 3})
+    group.add_members({4})
+    group.remove_members({4})
+    assert group.epoch == 0  # 密钥还没有发给任何人
+
+    first = group.wrapped_key(2, member_pem)
+    assert group.wrapped_key(2, member_pem) == first  # 同一周期只包装一次
+    key = group.key
+
+    group.add_members({4})
+    assert group.epoch == 1 and group.key != key
+    assert group.cached_wrap(2, member_pem) is None
+    group.add_members({5})
+    assert group.epoch == 1  # 新密钥还没有发出
+
+    group.mark_distributed()
+    group.remove_members({3})
+    assert group.epoch == 2 and group.members == {2, 4, 5}
+    assert not group.store_wrap(1, 2, member_pem, first)  # 旧周期的包装结果丢弃
+
+
+def _connect(sender, *members):
+    for member in members:
+        sender.peer_pubkeys[member.my_id] = serialize_public_key(member.pub_key)
+        member.peer_pubkeys[sender.my_id] = serialize_public_key(sender.pub_key)
+        sender.peer_caps[member.my_id] = {"seq"}
+
+
+def _group_frames(client, start):
+    assert wait_until(lambda: len(client.ws.sent) > start)
+    return [json_codec.loads(raw) for raw in client.ws.sent[start:]]
+
+
+def test_one_ciphertext_for_all_members_and_departed_member_locked_out(make_client):
+    a = make_client(1, "aaa")
+    b = make_client(2, "bbb")
+    c = make_client(3, "ccc")
+    _connect(a, b, c)
+    a.create_group("g", {2, 3})
+
+    assert a.send_group_message("g", "m1")
+    frames = _group_frames(a, 0)
+    assert {f["toId"] for f in frames} == {2, 3}
+    assert len({f["message"] for f in frames}) == 1  # 只加密一次
+    assert len({f["aesKey"] for f in frames}) == 2  # 每个成员各自的包装密钥
+    for member in (b, c):
+        frame = next(f for f in frames if f["toId"] == member.my_id)
+        run(member, member._dispatch(frame))
+        assert wait_until(lambda m=member: len(m.pushed) == 1)
+        assert member.pushed[0]["content"] == "m1"
+    old_key = next(iter(c.group_keys.values()))
+
+    a.update_group_members("g", remove={3})
+    assert a.groups["g"].epoch == 1
+    assert a.send_group_message("g", "m2")
+    frames = _group_frames(a, 2)
+    assert [f["toId"] for f in frames] == [2]
+
+    # 离开的成员即使拿到密文，用旧密钥也无法解密
+    data = base64.b64decode(frames[0]["message"])
+    with pytest.raises(InvalidTag):
+        aes_gcm_decrypt(old_key, data[:12], data[12:-16], data[-16:], b"")
+    run(c, c._dispatch(frames[0]))  # 包装密钥是给 b 的，c 解包失败
+    run(b, b._dispatch(frames[0]))
+    assert wait_until(lambda: len(b.pushed) == 2)
+    assert b.pushed[1]["content"] == "m2"
+    assert len(c.pushed) == 1
+
+
+def test_broadcast_members_follow_presence(make_client, monkeypatch):
+    a = make_client(1, "aaa")
+    b = make_client(2, "bbb")
+    c = make_client(3, "ccc")
+    _connect(a, b, c)
+    monkeypatch.setattr(ws_client, "online_users", {1: "aaa", 2: "bbb", 3: "ccc"})
+
+    assert a.broadcast_message("hi")
+    group = a.groups[BROADCAST_GROUP]
+    assert group.members == {2, 3} and group.epoch == 0
+    assert {f["toId"] for f in _group_frames(a, 0)} == {2, 3}
+
+    # 在线列表签名校验不是这里要测的，直接返回已校验的结果
+    monkeypatch.setattr(a, "server_pub_key", object())
+    monkeypatch.setattr(a, "_verify_presence", lambda entries: entries)
+    pem = a.peer_pubkeys[2]
+    run(a, a.handle_system_message([(1, "aaa", pem, None), (2, "bbb", pem, None)]))
+    assert group.members == {2} and group.epoch == 1
@@ -0,0 +1,36 @@
+import main
+from profiling import SamplingProfiler
+
+
+def test_start_while_running_keeps_interval():
+    profiler = SamplingProfiler(interval=0.005)
+    assert profiler.start(5, interval=0.002)
+    try:
+        assert not profiler.start(5, interval=0.5)
+        assert profiler.interval == 0.002
+    finally:
+        profiler.stop()
+
+
+def test_profile_start_conflict_does_not_change_interval(monkeypatch):
+    monkeypatch.setitem(main.app.config, "DEBUG_TOKEN", "t")
+    monkeypatch.setattr(main, "profiler", SamplingProfiler(interval=0.005))
+    http = main.app.test_client()
+    headers = {"X-Debug-Token": "t"}
+    try:
+        resp = http.post(
+            "/api/debug/profile/start",
+            json={"seconds": 5, "intervalMs": 2},
+            headers=headers,
+        )
+        assert resp.status_code == 200
+        resp = http.post(
+            "/api/debug/profile/start",
+            json={"seconds": 5, "intervalMs": 500},
+            headers=headers,
+        )
+        assert resp.status_code == 409
+        assert main.profiler.interval == 0.002
+        assert resp.get_json()["data"]["intervalMs"] == 2
+    finally:
+        main.profiler.stop()
@@ -0,0 +1,96 @@
+import pytest
+
+from rate_limit import ConcurrencyLimiter, RateLimiter, TokenBucket
+
+
+def test_token_bucket_burst_then_refill():
+    bucket = TokenBucket(rate=2, burst=3)
+    now = bucket.updated
+    assert [bucket.try_acquire(now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire(now) == pytest.approx(0.5)
+    assert bucket.try_acquire(now + 0.5) == 0.0
+    # 空闲很久也只能攒到 burst 个
+    assert [bucket.try_acquire(now + 100) for _ in range(4)][-1] > 0
+
+
+def test_token_bucket_zero_rate():
+    bucket = TokenBucket(rate=0, burst=1)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 60.0
+
+
+def test_rate_limiter_isolates_keys_and_bounds_buckets():
+    limiter = RateLimiter({"send": (0, 1)}, max_buckets=2)
+    assert limiter.check("a", "send") == 0
+    assert limiter.check("a", "send") > 0
+    assert limiter.check("b", "send") == 0  # 另一个用户不受影响
+    assert limiter.check("a", "other") == 0  # 未配置的接口不限流
+    limiter.check("c", "send")
+    assert len(limiter._buckets) == 2
+
+
+def test_concurrency_limiter_rejects_when_full():
+    limiter = ConcurrencyLimiter(1)
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    limiter.release()
+    assert limiter.try_acquire()
+
+
+class _Session:
+    search_index = None
+
+    def __init__(self, token):
+        self.token = token
+
+    def stop(self):
+        pass
+
+
+def test_spoofed_user_id_does_not_drain_user_bucket(monkeypatch):
+    """冒用别人的 id 而不带正确 token 的请求直接拒绝，不会耗尽别人的额度"""
+    import main
+
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter({"search": (0, 2)}))
+    main.ws_clients.register(1, _Session("secret"))
+    try:
+        http = main.app.test_client()
+        for headers in ({}, {"token": "guess"}) * 3:
+            resp = http.get("/api/search?userId=1&q=x", headers=headers)
+            assert resp.status_code == 403
+
+        owner = http.get("/api/search?userId=1&q=x", headers={"token": "secret"})
+        assert owner.status_code != 429
+    finally:
+        main.ws_clients.remove(1)
+
+
+def test_users_on_same_address_have_separate_buckets(monkeypatch):
+    """所有请求都来自本机地址时，每个带 token 的用户仍各有各的额度"""
+    import main
+
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter({"search": (0, 2)}))
+    main.ws_clients.register(1, _Session("t1"))
+    main.ws_clients.register(2, _Session("t2"))
+    try:
+        http = main.app.test_client()
+        busy = [
+            http.get("/api/search?userId=1&q=x", headers={"token": "t1"}).status_code
+            for _ in range(5)
+        ]
+        assert busy[-1] == 429
+        other = http.get("/api/search?userId=2&q=x", headers={"token": "t2"})
+        assert other.status_code != 429
+    finally:
+        main.ws_clients.remove(1)
+        main.ws_clients.remove(2)
+
+
+def test_non_object_json_body_is_rejected_with_400(monkeypatch):
+    import main
+
+    monkeypatch.setitem(main.app.config, "DEBUG_TOKEN", "t")
+    http = main.app.test_client()
+    assert http.post("/api/send_message", json=[1, 2]).status_code == 400
+    resp = http.get("/api/debug/tasks", json=[1, 2], headers={"X-Debug-Token": "t"})
+    assert resp.status_code == 200
@@ -0,0 +1,92 @@
+import pytest
+
+from crypto_utils import generate_rsa_keys
+from search_index import SearchIndex, message_key
+
+
+@pytest.fixture(scope="module")
+def rsa_keys():
+    return generate_rsa_keys()
+
+
+@pytest.fixture
+def open_index(tmp_path, rsa_keys):
+    opened = []
+
+    def factory():
+        index = SearchIndex("aaa", *rsa_keys, directory=str(tmp_path))
+        opened.append(index)
+        return index
+
+    yield factory
+    for index in opened:
+        index.close()
+
+
+def test_incremental_add_and_dedup_by_message_key(open_index):
+    index = open_index()
+    key = message_key("Y2lwaGVydGV4dA==")
+    assert index.add(key, 2, 1, 2, "明天下午三点开会") == 1
+    # 同一条消息从历史记录再加载一次（密文相同）不会重复
+    assert index.add(key, 2, 1, 2, "明天下午三点开会") == 0
+    assert (
+        index.add_many([(key, {"peerId": 2, "fromId": 1, "toId": 2, "content": "x"})])
+        == 0
+    )
+    assert index.add(message_key("b3RoZXI="), 3, 3, 1, "三点的会改到四点") == 1
+
+    hits = index.search("三点开会")
+    assert [h["chat"] for h in hits] == ["明天下午三点开会"]
+    assert hits[0]["snippet"] == "明天下午[三点开会]"
+    assert len(index.search("三点的")) == 1
+
+
+def test_rebuild_from_encrypted_db(open_index, tmp_path):
+    index = open_index()
+    index.add(message_key("bTE="), 2, 1, 2, "secret plans for friday")
+    index.close()
+
+    with open(tmp_path / "aaa_index.db", "rb") as f:
+        assert b"secret plans" not in f.read()
+
+    reopened = open_index()
+    assert [h["chat"] for h in reopened.search("plans")] == ["secret plans for friday"]
+    # 重建后已知的消息仍然去重
+    assert reopened.add(message_key("bTE="), 2, 1, 2, "secret plans for friday") == 0
+
+
+def test_peer_filter_and_short_query_fallback(open_index):
+    index = open_index()
+    index.add(message_key("MQ=="), 2, 1, 2, "好的")
+    index.add(message_key("Mg=="), 3, 3, 1, "好的，收到")
+    index.add(message_key("Mw=="), 2, 2, 1, "收到了")
+
+    # 少于 3 个字符时逐条子串查找，按时间倒序
+    assert [h["chat"] for h in index.search("好的")] == ["好的，收到", "好的"]
+    assert [h["chat"] for h in index.search("收到", peer_id=2)] == ["收到了"]
+    assert [h["peerId"] for h in index.search("收到了", peer_id="3")] == []
+    assert len(index.search("好", limit=1)) == 1
+
+
+def test_search_endpoint_requires_session_token(monkeypatch, open_index):
+    import main
+
+    class Session:
+        token = "t1"
+        search_index = open_index()
+
+        def stop(self):
+            pass
+
+    Session.search_index.add(message_key("eA=="), 2, 2, 1, "hello there")
+    main.ws_clients.register(1, Session())
+    try:
+        http = main.app.test_client()
+        assert http.get("/api/search?userId=1&q=hello").status_code == 403
+        resp = http.get("/api/search?userId=1&q=hello", headers={"token": "nope"})
+        assert resp.status_code == 403
+        resp = http.get("/api/search?userId=1&q=hello", headers={"token": "t1"})
+        assert resp.status_code == 200
+        assert [h["chat"] for h in resp.get_json()["data"]["hits"]] == ["hello there"]
+    finally:
+        main.ws_clients.remove(1)
@@ -0,0 +1,76 @@
+import pytest
+
+from sequencing import ReplayWindow, SequenceTracker, pack_seq, unpack_seq
+
+
+def test_pack_and_unpack_seq():
+    data = pack_seq(42, b"\xff\x01compressed")
+    assert unpack_seq(data) == (42, b"\xff\x01compressed")
+    assert unpack_seq("你好".encode()) == (None, "你好".encode())
+    with pytest.raises(ValueError):
+        unpack_seq(b"\xfe\x00\x01")
+
+
+def test_replay_window_rejects_duplicates_and_stale():
+    window = ReplayWindow(size=8)
+    assert window.check_and_set(1)
+    assert not window.check_and_set(1)
+    assert window.check_and_set(5)
+    assert window.check_and_set(3)  # 乱序但在窗口内
+    assert not window.check_and_set(3)
+    assert window.check_and_set(20)
+    assert not window.check_and_set(12)  # 早于窗口，视为重放
+    assert window.check_and_set(13)
+    assert not window.check_and_set(0)
+
+
+def test_replay_window_large_jump_resets_bitmap():
+    window = ReplayWindow(size=4)
+    for seq in (1, 2, 3):
+        assert window.check_and_set(seq)
+    assert window.check_and_set(100)
+    assert window.check_and_set(99)
+    assert not window.check_and_set(96)
+
+
+def test_tracker_reorders_and_drops_duplicates():
+    tracker = SequenceTracker()
+    assert tracker.accept(1, "a") == (True, ["a"])
+    assert tracker.accept(3, "c") == (True, [])
+    assert tracker.accept(2, "b") == (True, ["b", "c"])
+    assert tracker.accept(2, "b") == (False, [])
+
+
+def test_tracker_flush_skips_gap_and_late_message_is_delivered():
+    tracker = SequenceTracker()
+    tracker.accept(1, "a")
+    assert tracker.accept(3, "c") == (True, [])
+    assert tracker.accept(4, "d") == (True, [])
+    assert tracker.flush() == ["c", "d"]
+    assert tracker.accept(2, "b") == (True, ["b"])  # 缺口被跳过后才到达
+    assert tracker.accept(2, "b") == (False, [])
+
+
+def test_tracker_pending_limit_forces_flush():
+    tracker = SequenceTracker(max_pending=3)
+    delivered = []
+    for seq in (2, 3, 4):
+        delivered += tracker.accept(seq, seq)[1]
+    assert delivered == []
+    delivered += tracker.accept(5, 5)[1]
+    assert delivered == [2, 3, 4, 5]
+
+
+def test_tracker_without_start_begins_at_first_seq():
+    tracker = SequenceTracker(start=None)
+    assert tracker.accept(57, "x") == (True, ["x"])
+    assert tracker.accept(58, "y") == (True, ["y"])
+
+
+def test_tracker_floor_rejects_earlier_seqs():
+    tracker = SequenceTracker(floor=5)
+    assert tracker.high_water == 5
+    assert tracker.accept(1, "a") == (False, [])
+    assert tracker.accept(5, "e") == (False, [])
+    assert tracker.accept(6, "f") == (True, ["f"])
+    assert tracker.high_water == 6
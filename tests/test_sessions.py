@@ -0,0 +1,73 @@
+import threading
+import time
+
+from conftest import wait_until
+from sessions import SessionRegistry
+from ws_client import WSClient
+
+
+class StubClient:
+    def __init__(self):
+        self.last_activity = time.monotonic()
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+def test_sweep_counts_inbound_messages_and_touch_as_activity():
+    registry = SessionRegistry(idle_timeout=10)
+    idle, receiving, streaming = StubClient(), StubClient(), StubClient()
+    for user_id, client in ((1, idle), (2, receiving), (3, streaming)):
+        registry.register(user_id, client)
+
+    now = time.monotonic() + 60
+    receiving.last_activity = now - 1  # 只收消息，没有 API 调用
+    registry._last_active[3] = now - 1  # 等同于 SSE 连接期间的 touch()
+
+    assert registry.sweep(now) == [1]
+    assert idle.stopped
+    assert 2 in registry and 3 in registry
+    assert registry.touch(2) and not registry.touch(1)
+
+
+def test_relogin_and_logout_stop_client_threads(tmp_path, monkeypatch):
+    """重新登录替换掉的会话和注销的会话都要结束事件循环线程，线程数不随登录次数增长"""
+    import main
+
+    monkeypatch.chdir(tmp_path)
+    before = set(threading.enumerate())
+    clients = []
+    closed = []
+
+    class Http:  # 代替推送用的 requests.Session
+        def __init__(self, token):
+            self.token = token
+
+        def close(self):
+            closed.append(self.token)
+
+    for token in ("t1", "t2", "t3"):
+        client = WSClient(1, "aaa", token, "127.0.0.1", 5000)
+        client._http = Http(token)
+        main.ws_clients.register(1, client)
+        client.start()
+        clients.append(client)
+        assert wait_until(lambda c=client: c.loop is not None and c.loop.is_running())
+
+    assert [c._thread.is_alive() for c in clients] == [False, False, True]
+
+    resp = main.app.test_client().post(
+        "/api/logout", json={"user_id": 1}, headers={"token": "t3"}
+    )
+    assert resp.status_code == 200
+    assert not clients[-1]._thread.is_alive()
+    assert 1 not in main.ws_clients
+    assert closed == ["t1", "t2", "t3"]
+
+    def leaked():
+        # 注册表的空闲清理线程在第一次登录时启动，常驻
+        reaper = main.ws_clients._reaper
+        return [t for t in threading.enumerate() if t not in before and t is not reaper]
+
+    assert wait_until(lambda: not leaked()), leaked()
@@ -0,0 +1,51 @@
+from sse import EventBroadcaster, encode_event
+
+
+def _drain(q):
+    events = []
+    while not q.empty():
+        events.append(q.get_nowait())
+    return events
+
+
+def test_events_without_subscribers_go_to_next_subscriber():
+    events = EventBroadcaster()
+    assert events.publish({"content": "a"}) == 0
+    assert events.publish({"content": "b"}) == 0
+
+    first = events.subscribe()
+    assert _drain(first) == [
+        encode_event({"content": "a"}, 1),
+        encode_event({"content": "b"}, 2),
+    ]
+    # 已交给过订阅者的事件不会再补发给之后的新连接
+    assert _drain(events.subscribe()) == []
+
+
+def test_last_event_id_replays_missed_events():
+    events = EventBroadcaster(replay=3)
+    q = events.subscribe()
+    for i in range(1, 6):
+        events.publish({"content": i})
+    events.unsubscribe(q)
+
+    assert _drain(events.subscribe(last_event_id=3)) == [
+        encode_event({"content": 4}, 4),
+        encode_event({"content": 5}, 5),
+    ]
+    # 超出保留范围的只能补发最近 3 条
+    assert len(_drain(events.subscribe(last_event_id=0))) == 3
+    # 服务重启前的 id 大于当前 id，按新订阅者处理
+    assert _drain(events.subscribe(last_event_id=99)) == []
+
+
+def test_stream_sends_keepalive_and_event_ids():
+    events = EventBroadcaster()
+    touched = []
+    stream = events.stream(on_keepalive=lambda: touched.append(1), keepalive=0.01)
+    assert next(stream) == b": keepalive\n\n"
+    assert touched == [1]
+    events.publish({"fromId": 2, "content": "hi"})
+    assert next(stream).startswith(b"id: 1\ndata: ")
+    stream.close()
+    assert len(events) == 0
@@ -0,0 +1,385 @@
+import asyncio
+import base64
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+import json_codec
+from conftest import run, wait_until
+from crypto_executor import CryptoExecutor
+from compression import encode_payload
+from crypto_utils import (
+    aes_gcm_encrypt,
+    generate_rsa_keys,
+    gen_sym_key,
+    rsa_encrypt,
+    serialize_public_key,
+    serialize_raw_public_key,
+)
+from sequencing import pack_seq, seq_aad
+from ws_client import MAX_STREAMS_PER_PEER, UNDECRYPTABLE
+
+
+def _presence_entry(server_priv, user_id, username, pub_pem):
+    signature = server_priv.sign(pub_pem.encode(), padding.PKCS1v15(), hashes.SHA256())
+    return {
+        "id": user_id,
+        "username": username,
+        "publicKey": pub_pem,
+        "enpublicKey": base64.b64encode(signature).decode(),
+    }
+
+
+def test_handshake_after_presence_waits_for_presence(make_client):
+    """在线列表后紧跟的密钥交换帧要用到列表里的公钥，不能先于列表处理"""
+    server_priv, server_pub = generate_rsa_keys()
+    with open("server_public.pem", "w") as f:
+        f.write(serialize_public_key(server_pub))
+
+    a = make_client(1, "aaa")
+    b = make_client(2, "bbb")
+    # 多个 crypto 线程时，在线列表校验和密钥解包会并行执行
+    a.crypto = CryptoExecutor(ThreadPoolExecutor(max_workers=4))
+    b_pem = serialize_public_key(b.pub_key)
+
+    # 列表足够长，校验耗时明显长于一次 RSA 解包
+    other_pem = serialize_public_key(generate_rsa_keys()[1])
+    users = [_presence_entry(server_priv, 2, "bbb", b_pem)] + [
+        _presence_entry(server_priv, user_id, f"u{user_id}", other_pem)
+        for user_id in range(3, 300)
+    ]
+
+    K = gen_sym_key()
+    handshake = {
+        "fromId": 2,
+        "toId": 1,
+        "message": "",
+        "aesKey": base64.b64encode(rsa_encrypt(a.pub_key, K)).decode(),
+    }
+
+    async def feed():
+        await a._dispatch({"systemMessage": True, "message": users})
+        await a._dispatch(handshake)
+
+    run(a, feed())
+    assert wait_until(lambda: a.key_status.get(2) == "confirmed")
+    confirm = json_codec.loads(a.ws.sent[-1])
+    assert confirm["toId"] == 2 and confirm["message"] == ""
+
+
+def test_slow_push_does_not_stall_event_loop(make_client):
+    """推送到浏览器的 HTTP 请求很慢时，事件循环延迟仍应保持在较低水平"""
+    a = make_client(1, "aaa")
+    b = make_client(2, "bbb")
+    _connect_v2(a, b, caps=())
+
+    pushed = []
+
+    def slow_push(data):
+        time.sleep(0.1)  # 模拟阻塞的 requests.post
+        pushed.append(data["content"])
+
+    a._push = slow_push
+
+    for i in range(5):
+        assert b.send_encrypted_message(1, f"m{i}")
+    assert wait_until(lambda: len(b.ws.sent) == 5)
+    frames = [json_codec.loads(raw) for raw in b.ws.sent]
+
+    async def measure():
+        lags = []
+        for frame in frames:
+            await a._dispatch(frame)
+        deadline = time.monotonic() + 0.8
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            await asyncio.sleep(0.01)
+            lags.append(time.monotonic() - start - 0.01)
+        return max(lags)
+
+    max_lag = run(a, measure())
+    assert wait_until(lambda: len(pushed) == 5)
+    assert pushed == [f"m{i}" for i in range(5)]
+    assert max_lag < 0.05
+
+
+def _connect_v2(a, b, caps=("seq",)):
+    a.peer_pubkeys[b.my_id] = serialize_public_key(b.pub_key)
+    b.peer_pubkeys[a.my_id] = serialize_public_key(a.pub_key)
+    a.peer_ecdh[b.my_id] = b.ecdh_pub
+    b.peer_ecdh[a.my_id] = a.ecdh_pub
+    a.ecdh_published = b.ecdh_published = True  # 双方的 ecdhKey 都在在线列表中
+    a.peer_caps[b.my_id] = set(caps)
+    b.peer_caps[a.my_id] = set(caps)
+
+
+def _send(sender, target, text):
+    count = len(sender.ws.sent)
+    assert sender.send_encrypted_message(target.my_id, text)
+    assert wait_until(lambda: len(sender.ws.sent) == count + 1)
+    frame = json_codec.loads(sender.ws.sent[-1])
+    delivered = len(target.pushed)
+    run(target, target._dispatch(frame))
+    assert wait_until(lambda: len(target.pushed) == delivered + 1)
+    return frame
+
+
+def test_relogin_never_reuses_key_and_iv(make_client):
+    """重新登录后序号从 1 开始，不能在同一会话密钥下重复使用 IV，也不能被当成重放丢弃"""
+    a = make_client(1, "aaa")
+    b1 = make_client(2, "bbb")
+    _connect_v2(a, b1)
+
+    frames = [_send(a, b1, "h1"), _send(b1, a, "r1")]
+
+    b2 = make_client(2, "bbb")  # 同一用户重新登录：X25519 密钥相同，状态全部丢失
+    _connect_v2(a, b2)
+    frames += [_send(a, b2, "h2"), _send(b2, a, "r2")]
+
+    assert [p["content"] for p in a.pushed] == ["r1", "r2"]
+    assert [p["content"] for p in b2.pushed] == ["h2"]
+
+    # 两次登录的 b 各自用自己的 salt 派生发送密钥
+    assert frames[1]["aesKey"] != frames[3]["aesKey"]
+    assert frames[1]["aesKey"] != frames[0]["aesKey"]
+
+    seen = set()
+    for frame in frames:
+        K = a.unwrap_session_key(
+            frame["toId"] if frame["fromId"] == 1 else frame["fromId"], frame["aesKey"]
+        )
+        iv = base64.b64decode(frame["message"])[:12]
+        assert (K, iv) not in seen
+        seen.add((K, iv))
+
+
+def _group_frame(sender_id, receiver, group_id, K, seq, text):
+    iv, ct, tag = aes_gcm_encrypt(
+        K, pack_seq(seq, encode_payload(text)), aad=seq_aad(sender_id, None, group_id)
+    )
+    return {
+        "fromId": sender_id,
+        "toId": receiver.my_id,
+        "groupId": group_id,
+        "caps": "seq",
+        "seq": seq,
+        "message": base64.b64encode(iv + ct + tag).decode(),
+        "aesKey": base64.b64encode(rsa_encrypt(receiver.pub_key, K)).decode(),
+    }
+
+
+def test_group_key_rotation_keeps_sender_state_bounded(make_client):
+    """群组密钥多次轮换后，每个发送方只保留最近的序号状态，且群组发送方计入 LRU"""
+    a = make_client(1, "aaa")
+    for epoch in range(5):
+        frame = _group_frame(3, a, 7, gen_sym_key(), 1, f"e{epoch}")
+        run(a, a._dispatch(frame))
+        assert wait_until(lambda n=epoch + 1: len(a.pushed) == n)
+
+    assert [p["content"] for p in a.pushed] == [f"e{i}" for i in range(5)]
+    assert len([k for k in a._seq_trackers if k[:2] == (3, 7)]) == MAX_STREAMS_PER_PEER
+    assert 3 in a._peer_lru
+
+    a.max_peer_state = 1
+    a._touch_peer(4)  # 淘汰用户 3 的全部状态
+    assert wait_until(lambda: not [k for k in a._seq_trackers if k[0] == 3])
+    assert 3 not in a.peer_caps
+
+
+def test_new_session_resets_sender_state(make_client):
+    """对方多次重新登录（新的会话密钥）后，两端的序号状态不随之累积"""
+    a = make_client(1, "aaa")
+    for i in range(4):
+        b = make_client(2, "bbb")
+        _connect_v2(a, b)
+        _send(b, a, f"r{i}")
+        _send(a, b, f"h{i}")
+
+    assert [p["content"] for p in a.pushed] == [f"r{i}" for i in range(4)]
+    assert len([k for k in a._seq_trackers if k[0] == 2]) == MAX_STREAMS_PER_PEER
+    assert len([k for k in a.send_seq if k[0] == 2]) == 1
+
+
+def _forward(src, dst, start):
+    """把 src 从第 start 帧起发出的帧交给 dst 处理，返回下一次转发的起点"""
+    end = len(src.ws.sent)
+    for raw in src.ws.sent[start:end]:
+        run(dst, dst._dispatch(json_codec.loads(raw)))
+    return end
+
+
+def test_v2_requires_own_ecdh_key_in_presence(make_client):
+    """只有一方上传过 X25519 公钥时双方都使用 v1，消息能正常送达"""
+    server_priv, server_pub = generate_rsa_keys()
+    with open("server_public.pem", "w") as f:
+        f.write(serialize_public_key(server_pub))
+    a = make_client(1, "aaa")
+    b = make_client(2, "bbb")
+
+    a_entry = _presence_entry(server_priv, 1, "aaa", serialize_public_key(a.pub_key))
+    ecdh_key = serialize_raw_public_key(a.ecdh_pub)
+    signature = server_priv.sign(ecdh_key.encode(), padding.PKCS1v15(), hashes.SHA256())
+    a_entry.update(ecdhKey=ecdh_key, enEcdhKey=base64.b64encode(signature).decode())
+    # b 是旧账号：注册时还没有上传 ecdhKey
+    b_entry = _presence_entry(server_priv, 2, "bbb", serialize_public_key(b.pub_key))
+    for client in (a, b):
+        run(client, client.handle_system_message([a_entry, b_entry]))
+
+    assert a.ecdh_published and 2 not in a.peer_ecdh
+    assert not b.ecdh_published and 1 in b.peer_ecdh
+
+    assert b.send_encrypted_message(1, "hi")
+    assert wait_until(lambda: len(b.ws.sent) == 1)
+    handshake = json_codec.loads(b.ws.sent[0])
+    assert handshake["message"] == ""
+    assert not handshake["aesKey"].startswith("x25519:")
+
+    _forward(b, a, 0)
+    assert wait_until(lambda: len(a.ws.sent) == 1)  # a 的密钥确认
+    _forward(a, b, 0)
+    assert wait_until(lambda: len(b.ws.sent) == 2)  # 队列中的消息
+    _forward(b, a, 1)
+    assert wait_until(lambda: [p["content"] for p in a.pushed] == ["hi"])
+
+    _send(a, b, "yo")
+    assert [p["content"] for p in b.pushed] == ["yo"]
+
+
+def test_undecryptable_v2_message_falls_back_to_rsa(make_client):
+    """对方无法派生 v2 密钥时通知浏览器并回复发送方，发送方之后改用 RSA"""
+    a = make_client(1, "aaa")
+    b = make_client(2, "bbb")
+    a.peer_pubkeys[2] = serialize_public_key(b.pub_key)
+    b.peer_pubkeys[1] = serialize_public_key(a.pub_key)
+    a.peer_ecdh[2] = b.ecdh_pub
+    a.ecdh_published = True  # a 认为自己的公钥已上传，b 却没有 a 的 X25519 公钥
+
+    assert a.send_encrypted_message(2, "m1")
+    assert wait_until(lambda: len(a.ws.sent) == 1)
+    assert json_codec.loads(a.ws.sent[0])["aesKey"].startswith("x25519:")
+    _forward(a, b, 0)
+    assert wait_until(lambda: len(b.ws.sent) == 1)
+    assert b.pushed == [{"fromId": 1, "content": UNDECRYPTABLE}]
+
+    _forward(b, a, 0)
+    assert wait_until(lambda: 2 in a.v2_rejected)
+    assert 2 not in a.sym_keys
+
+    assert a.send_encrypted_message(2, "m2")
+    assert wait_until(lambda: len(a.ws.sent) == 2)
+    assert not json_codec.loads(a.ws.sent[1])["aesKey"].startswith("x25519:")
+    _forward(a, b, 1)
+    assert wait_until(lambda: len(b.ws.sent) == 2)
+    _forward(b, a, 1)
+    assert wait_until(lambda: len(a.ws.sent) == 3)
+    _forward(a, b, 2)
+    assert wait_until(lambda: len(b.pushed) == 2)
+    assert b.pushed[1]["content"] == "m2"
+
+
+def test_evicted_v1_session_recovers_from_inbound_message(make_client):
+    """v1 会话的状态被淘汰后，对方继续发来的消息仍能解密，回复也能送达"""
+    a = make_client(1, "aaa")
+    b = make_client(2, "bbb")
+    _connect_v2(a, b)
+    a.ecdh_published = b.ecdh_published = False  # 没有上传 X25519 公钥，使用 v1
+
+    assert b.send_encrypted_message(1, "h0")
+    assert wait_until(lambda: len(b.ws.sent) == 1)
+    _forward(b, a, 0)
+    assert wait_until(lambda: len(a.ws.sent) == 1)
+    _forward(a, b, 0)
+    assert wait_until(lambda: len(b.ws.sent) == 2)
+    _forward(b, a, 1)
+    assert wait_until(lambda: len(a.pushed) == 1)
+
+    a.max_peer_state = 1
+    a._touch_peer(99)
+    assert wait_until(lambda: 2 not in a.sym_keys)
+
+    _send(b, a, "h1")
+    _send(a, b, "r1")
+    assert [p["content"] for p in a.pushed] == ["h0", "h1"]
+    assert [p["content"] for p in b.pushed] == ["r1"]
+
+
+def test_replayed_frames_of_retired_sessions_are_dropped(make_client):
+    """会话的去重状态被丢弃后（更新的会话、淘汰、重新登录），旧密文仍不能重放"""
+    a = make_client(1, "aaa")
+    frames = []
+    for i in range(3):
+        b = make_client(2, "bbb")
+        _connect_v2(a, b)
+        frames.append(_send(b, a, f"r{i}"))
+    assert [p["content"] for p in a.pushed] == ["r0", "r1", "r2"]
+
+    def replay(client, frame):
+        run(client, client._dispatch(frame))
+        run(client, asyncio.sleep(0.1))  # 等待解密（线程池）和交付
+
+    replay(a, frames[0])  # 已被两个更新的会话挤出
+    a.max_peer_state = 1
+    a._touch_peer(99)  # 淘汰用户 2 的全部状态
+    assert wait_until(lambda: not a._seq_trackers)
+    replay(a, frames[2])
+    _send(b, a, "r3")  # 同一会话的新消息仍然接受
+    assert [p["content"] for p in a.pushed] == ["r0", "r1", "r2", "r3"]
+
+    # 重新登录后同样丢弃
+    run(a, asyncio.sleep(0))
+    a.loop.call_soon_threadsafe(a.loop.stop)
+    a._thread.join(timeout=5)
+    a.loop.close()
+    a.stop()
+    a2 = make_client(1, "aaa")
+    _connect_v2(a2, b)
+    for frame in frames:
+        replay(a2, frame)
+    assert a2.pushed == []
+
+
+def test_handshake_storm_keeps_event_loop_responsive(make_client):
+    """大量 RSA 密钥交换帧与大的在线列表同时到达时，事件循环延迟仍应有上限"""
+    server_priv, server_pub = generate_rsa_keys()
+    with open("server_public.pem", "w") as f:
+        f.write(serialize_public_key(server_pub))
+    a = make_client(1, "aaa")
+    a.crypto = CryptoExecutor(ThreadPoolExecutor(max_workers=4))
+    peer_priv, peer_pub = generate_rsa_keys()
+    pem = serialize_public_key(peer_pub)
+
+    # 每个条目的公钥文本都不同（末尾换行数不同），校验结果不会命中缓存
+    senders = range(2, 302)
+    users = [_presence_entry(server_priv, 1, "aaa", serialize_public_key(a.pub_key))]
+    users += [_presence_entry(server_priv, i, f"u{i}", pem + "\n" * i) for i in senders]
+    handshakes = [
+        {
+            "fromId": i,
+            "toId": 1,
+            "message": "",
+            "aesKey": base64.b64encode(rsa_encrypt(a.pub_key, gen_sym_key())).decode(),
+        }
+        for i in senders[:200]
+    ]
+
+    async def storm():
+        await a._dispatch({"systemMessage": True, "message": users})
+        for frame in handshakes:
+            await a._dispatch(frame)
+        lags = []
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            await asyncio.sleep(0.01)
+            lags.append(time.monotonic() - start - 0.01)
+            if sum(s == "confirmed" for s in a.key_status.values()) == 200:
+                break
+        return lags
+
+    lags = run(a, storm(), timeout=60)
+    assert sum(s == "confirmed" for s in a.key_status.values()) == 200
+    assert len(a.ws.sent) == 200  # 每个发送方一条确认
+    # RSA 解包、签名校验都在事件循环上执行时约 100ms 以上
+    assert max(lags) < 0.05
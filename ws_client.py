@@ -1,30 +1,78 @@
 import asyncio
 import threading
-import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import hashlib
+import os
 import websockets
 from flask import Flask
 from crypto_utils import (
     load_or_generate_keys,
     load_public_key,
-    rsa_verify,
+    verify_signature,
     rsa_decrypt,
     rsa_encrypt,
     gen_sym_key,
     aes_gcm_encrypt,
     aes_gcm_decrypt,
     serialize_public_key,
+    load_or_generate_ecdh_keys,
+    load_x25519_public_key,
+    serialize_raw_public_key,
+    derive_session_key,
+    ECDH_KEY_PREFIX,
 )
+from group_session import GroupSession, BROADCAST_GROUP
+from crypto_executor import CryptoExecutor
+from search_index import SearchIndex, message_key
+from sequencing import (
+    SequenceTracker,
+    pack_seq,
+    unpack_seq,
+    seq_aad,
+    REORDER_TIMEOUT,
+)
+from compression import (
+    supported_algorithms,
+    choose_algorithm,
+    encode_payload,
+    decode_payload,
+)
+import json_codec
 
 online_users = {}  # id -> username
 message = {}
 
+MAX_INFLIGHT_FRAMES = 256  # 已读取但尚未处理完的帧上限，超出后暂停读取
+MAX_QUEUED_MESSAGES = 200  # 每个用户等待密钥交换的消息上限
+MAX_PEER_STATE = 256  # 保留会话密钥等状态的用户数上限，超出时淘汰最久未通信的
+MAX_CACHED_KEYS = 4096  # 解包/派生结果缓存的条目上限
+MAX_STREAMS_PER_PEER = 2  # 每个发送方（单聊或群组）保留序号状态的会话密钥数
+MAX_RETIRED_STREAMS = 4096  # 记录已丢弃序号状态的会话（及其最大序号）的条目上限
+# 随每个发出的帧声明本端能力：支持的压缩算法，以及 "seq"（带序号的帧）
+LOCAL_CAPS = ",".join(supported_algorithms() + ["seq"])
+# 收到无法解密的 v2 消息时回复给发送方的 error 字段，对方随后改用 RSA 密钥交换
+V2_REJECTED = "x25519-undecryptable"
+UNDECRYPTABLE = "[无法解密消息]"
+
+
+def _bounded_put(cache, key, value, limit):
+    """写入缓存，超过上限时淘汰最早写入的条目"""
+    cache[key] = value
+    while len(cache) > limit:
+        cache.pop(next(iter(cache)))
+
 
 class WSClient:
     def __init__(self, id, username, token, host, port):
         self.my_id = id
         self.username = username
         self.token = token
+        self.last_activity = (
+            time.monotonic()
+        )  # 最近一次收到消息的时间，用于会话空闲判断
         self.flask_server = host + str(port)
 
         self.ws = None
@@ -37,15 +85,134 @@ class WSClient:
         self.sym_aeskeysb64 = {}  # id -> enAES key
         self.key_status = {}  # id -> str: 'pending', 'confirmed', 'error'
         self.message_queue = {}  # id -> list: 待发送的消息队列
+        self.max_queued = MAX_QUEUED_MESSAGES
+        self.groups = {}  # group_id -> GroupSession
+        self.group_keys = {}  # 收到的 base64 包装密钥 -> 群组 AES key
+        self.peer_ecdh = {}  # id -> X25519 公钥（对方支持协议 v2 时才有）
+        self.v2_rejected = set()  # 回复过无法解密 v2 消息的用户，改用 RSA
+        # 在线列表中本人的 ecdhKey 与本地 X25519 公钥一致（已上传到服务器）时才发起 v2，
+        # 否则对方没有本端的公钥，无法派生出同一个会话密钥
+        self.ecdh_published = False
+        self.session_key_cache = {}  # (id, aesKey) -> AES key，避免重复 RSA 解包/派生
+        self.crypto = CryptoExecutor()  # RSA 私钥运算等在线程池中执行
+        self.peer_caps = {}  # id -> set: 对方声明的能力（压缩算法、seq）
+        self.send_seq = {}  # (id, aesKey) -> 最近发出的序号
+        self.group_seq = {}  # 群组 id -> (密钥周期, 最近发出的序号)
+        self._seq_trackers = {}  # (发送方 id, 群组 id, aesKey) -> SequenceTracker
+        self._reorder_timers = {}  # (发送方 id, 群组 id, aesKey) -> 缺口超时定时器
+        self._peer_locks = {}  # id -> asyncio.Lock，保证同一用户的消息按序处理
+        self._presence_cache = {}  # 已校验的在线列表条目 -> X25519 公钥或 None
+        self._presence_gen = 0  # 在线列表版本号，只应用最新一次的校验结果
+        self._presence_task = None  # 最近一次在线列表的处理任务，之后到达的帧要等它完成
+        self._inflight = None  # 延迟初始化，限制在途帧数量
+        self._tasks = set()
+        self._peer_lru = OrderedDict()  # 最近通信的用户，用于淘汰每个用户的加密状态
+        self.max_peer_state = MAX_PEER_STATE
+        self._thread = None
+        self._main_task = None
+        self._stopping = False
+        self.lag_monitor = None  # 调试接口开启的事件循环延迟监控
+        self._push_executor = None  # 推送给浏览器的 HTTP 请求在单独线程中按序执行
+        self._http = None
         self.priv_key, self.pub_key = load_or_generate_keys(username)
+        self.ecdh_priv, self.ecdh_pub = load_or_generate_ecdh_keys(username)
+        self._ecdh_pub_b64 = serialize_raw_public_key(self.ecdh_pub)
+        # 校验过的对方 X25519 公钥持久化保存，对方离线后仍可解密 v2 历史记录
+        self._known_ecdh_path = f"./keys/{username}_peer_ecdh.json"
+        self._known_ecdh_lock = threading.Lock()
+        self._known_ecdh = self._load_known_ecdh()  # id -> base64 X25519 公钥
+        # 已丢弃序号状态的会话 -> 见过的最大序号；同一会话的旧密文再次到达时按重放丢弃。
+        # 注销时写盘，重新登录后仍然有效
+        self._retired_path = f"./keys/{username}_retired_streams.json"
+        self._retired_streams = self._load_retired_streams()
+        try:
+            self.search_index = SearchIndex(username, self.priv_key, self.pub_key)
+        except Exception as e:
+            print(f"[搜索索引] 初始化失败，本次会话不建立索引: {e}")
+            self.search_index = None
         self.server_pub_key = None
 
     def start(self):
+        # 事件循环线程还在时（例如正在重连）不再重复启动
+        if self._stopping or (self._thread is not None and self._thread.is_alive()):
+            return
         if not self.connected:
             t = threading.Thread(target=self.run)
             t.daemon = True
+            self._thread = t
             t.start()
 
+    @property
+    def loop_thread_id(self):
+        """事件循环线程的 ident（调试接口抓取调用栈用），未启动时为 None"""
+        thread = self._thread
+        return thread.ident if thread is not None else None
+
+    def stop(self):
+        """关闭连接、结束事件循环线程并释放本会话的状态（登出、重新登录、空闲清理时调用）"""
+        self._stopping = True
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+            self.lag_monitor = None
+        loop = self.loop
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), loop)
+
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+        with self._lock:
+            for stream_key, tracker in self._seq_trackers.items():
+                self._retire_stream(stream_key, tracker)
+            self._save_retired_streams()
+            self.ws = None
+            self.connected = False
+            for state in (
+                self.sym_keys,
+                self.sym_aeskeysb64,
+                self.key_status,
+                self.message_queue,
+                self.groups,
+                self.group_keys,
+                self.session_key_cache,
+                self.peer_caps,
+                self.v2_rejected,
+                self.send_seq,
+                self.group_seq,
+                self._seq_trackers,
+                self._peer_lru,
+            ):
+                state.clear()
+        if self.search_index is not None:
+            self.search_index.close()
+            self.search_index = None
+        if self._push_executor is not None:
+            self._push_executor.shutdown(wait=False)
+            self._push_executor = None
+        if self._http is not None:
+            self._http.close()  # 释放推送用的连接池
+            self._http = None
+        print(f"[会话] 用户 {self.username} (ID: {self.my_id}) 已注销")
+
+    async def _shutdown(self):
+        for timer in self._reorder_timers.values():
+            timer.cancel()
+        self._reorder_timers.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._main_task is not None:
+            self._main_task.cancel()  # 退出 websockets.connect 时会关闭连接
+
+    def _close_loop(self):
+        loop = self.loop
+        pending = [t for t in asyncio.all_tasks(loop) if not t.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
     def run(self, server_address="172.16.2.82:8080"):
         try:
             if not self.loop:
@@ -58,12 +225,18 @@ class WSClient:
             else:
                 # 如果loop已经在运行，使用run_coroutine_threadsafe
                 asyncio.run_coroutine_threadsafe(self._run(server_address), self.loop)
+        except asyncio.CancelledError:
+            pass  # stop() 取消了主任务
         except Exception as e:
             print(f"[错误] Event loop 错误: {e}")
+        finally:
+            if self._stopping and not self.loop.is_running():
+                self._close_loop()
 
     async def _run(self, server_address):
         ws_url = f"ws://{server_address}/chat"
-        while True:
+        self._main_task = asyncio.current_task()
+        while not self._stopping:
             try:
                 async with websockets.connect(
                     ws_url, additional_headers={"token": self.token}
@@ -74,11 +247,8 @@ class WSClient:
                     print(f"[WebSocket已连接] 用户: {self.username} (ID: {self.my_id})")
 
                     async for raw in ws:
-                        msg = json.loads(raw)
-                        if msg.get("systemMessage"):
-                            await self.handle_system_message(msg["message"])
-                        else:
-                            await self.handle_user_message(msg)
+                        msg = json_codec.loads(raw)
+                        await self._dispatch(msg)
 
             except Exception as e:
                 print(f"[错误] WebSocket连接断开: {e}，5秒后重连...")
@@ -87,6 +257,39 @@ class WSClient:
                     self.connected = False
                 await asyncio.sleep(4)
 
+    async def _dispatch(self, msg):
+        """每帧交给独立任务处理，读取循环不会被加解密阻塞"""
+        if self._inflight is None:
+            self._inflight = asyncio.Semaphore(MAX_INFLIGHT_FRAMES)
+        await self._inflight.acquire()
+
+        is_presence = bool(msg.get("systemMessage"))
+        if is_presence:
+            coro = self.handle_system_message(msg["message"])
+        else:
+            # 在线列表之后到达的帧可能依赖其中的公钥，要等该列表生效后再处理
+            coro = self._handle_user_frame(msg, self._presence_task)
+
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._frame_done)
+        if is_presence:
+            self._presence_task = task
+
+    def _frame_done(self, task):
+        self._tasks.discard(task)
+        self._inflight.release()
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[错误] 消息处理异常: {task.exception()}")
+
+    async def _handle_user_frame(self, msg, presence=None):
+        # 任务按到达顺序创建，asyncio.Lock 按 FIFO 唤醒，同一用户的消息保持顺序
+        lock = self._peer_locks.setdefault(msg.get("fromId"), asyncio.Lock())
+        async with lock:
+            if presence is not None and not presence.done():
+                await asyncio.wait({presence})
+            await self.handle_user_message(msg)
+
     async def ensure_connection(self):
         """确保WebSocket连接存在"""
         if not self.connected or self.ws is None:
@@ -101,50 +304,274 @@ class WSClient:
                 raise Exception("无法建立WebSocket连接")
         return self.ws
 
-    def decrypt_message(self, from_id, message, K=None):
+    def decrypt_message(self, from_id, message, K=None, aad=None):
         if K is None:
             K = self.sym_keys[from_id]
+        return self._open_message(message, K, aad)[1]
+
+    @staticmethod
+    def _open_message(message, K, aad=None):
+        """解密消息密文，返回 (加密在内的序号或 None, 明文)"""
         enc_bytes = base64.b64decode(message)
         iv, ct, tag = enc_bytes[:12], enc_bytes[12:-16], enc_bytes[-16:]
-        plaintext = aes_gcm_decrypt(K, iv, ct, tag).decode()
-        return plaintext
+        seq, payload = unpack_seq(aes_gcm_decrypt(K, iv, ct, tag, aad))
+        return seq, decode_payload(payload)
 
     async def handle_system_message(self, users):
         if self.server_pub_key is None:
+            # 服务器公钥可以是 RSA 或 Ed25519，只解析一次
             with open("./server_public.pem", "r") as f:
-                server_pub_pem = f.read()
-            self.server_pub_key = server_pub_pem
+                self.server_pub_key = load_public_key(f.read())
+
+        self._presence_gen += 1
+        gen = self._presence_gen
+        verified = await self.crypto.run(self._verify_presence, users)
+        if gen != self._presence_gen:
+            # 校验期间又收到了新的在线列表，旧结果丢弃；等新列表生效后才结束，
+            # 等待本列表的消息帧不会在任何列表生效之前被处理
+            newer = self._presence_task
+            if newer is not None and newer is not asyncio.current_task():
+                await asyncio.wait({newer})
+            return
 
         new_online = {}
+        for user_id, username, pub_pem, ecdh_pub in verified:
+            self.peer_pubkeys[user_id] = pub_pem
+            if ecdh_pub is not None:
+                self.peer_ecdh[user_id] = ecdh_pub
+            else:
+                self.peer_ecdh.pop(user_id, None)
+            new_online[user_id] = username
+            if user_id == self.my_id:
+                self.ecdh_published = (
+                    ecdh_pub is not None
+                    and serialize_raw_public_key(ecdh_pub) == self._ecdh_pub_b64
+                )
+        if self.my_id not in new_online:
+            self.ecdh_published = False
+
+        # 已下线且最近没有通信的用户不再保留公钥
+        with self._lock:
+            recent = set(self._peer_lru)
+        for user_id in list(self.peer_pubkeys):
+            if user_id not in new_online and user_id not in recent:
+                self.peer_pubkeys.pop(user_id, None)
+                self.peer_ecdh.pop(user_id, None)
+
+        online_users.clear()
+        online_users.update(new_online)
+
+        # 广播组跟随在线用户变化：成员有增减时轮换密钥，下次广播时重新包装
+        broadcast = self.groups.get(BROADCAST_GROUP)
+        if broadcast is not None:
+            with self._lock:
+                broadcast.set_members(set(new_online) - {self.my_id})
+
+        print("[系统消息] 当前在线用户：", online_users)
+
+    def _verify_presence(self, users):
+        """在线列表签名校验（在 crypto 线程池中执行），校验过的条目直接复用"""
+        verified = []
+        fresh_cache = {}  # 只保留当前在线列表中的条目
         for u in users:
             try:
-                public_key = u["publicKey"].encode()
-                enpublic_key = base64.b64decode(u["enpublicKey"])
-
-                if rsa_verify(self.server_pub_key, public_key, enpublic_key):
-                    pub_pem = u["publicKey"]
-                    user_id = int(u["id"])  # 确保 ID 是整数
-                    self.peer_pubkeys[user_id] = pub_pem
-                    new_online[user_id] = u["username"]
+                user_id = int(u["id"])  # 确保 ID 是整数
+                cache_key = (
+                    u["publicKey"],
+                    u["enpublicKey"],
+                    u.get("ecdhKey"),
+                    u.get("enEcdhKey"),
+                )
+                if cache_key in self._presence_cache:
+                    ecdh_pub = self._presence_cache[cache_key]
+                    fresh_cache[cache_key] = ecdh_pub
+                else:
+                    verify_signature(
+                        self.server_pub_key,
+                        u["publicKey"].encode(),
+                        base64.b64decode(u["enpublicKey"]),
+                    )
+                    ecdh_pub = self._verify_peer_ecdh(user_id, u)
+                    fresh_cache[cache_key] = ecdh_pub
                     print(f"[系统消息] 成功加载用户 {user_id} 的公钥")
 
+                verified.append((user_id, u["username"], u["publicKey"], ecdh_pub))
+
             except Exception as e:
                 print(f"[系统消息处理错误] 用户 {u.get('id', 'unknown')}: {str(e)}")
+        self._presence_cache = fresh_cache
+        return verified
 
-        online_users.clear()
-        online_users.update(new_online)
+    def _verify_peer_ecdh(self, user_id, u):
+        """协议协商：在线列表里带有服务器签名的 ecdhKey 时，与该用户使用 v2"""
+        ecdh_key = u.get("ecdhKey")
+        en_ecdh_key = u.get("enEcdhKey")
+        if not ecdh_key or not en_ecdh_key:
+            return None
 
-        print("[系统消息] 当前在线用户：", online_users)
+        try:
+            verify_signature(
+                self.server_pub_key, ecdh_key.encode(), base64.b64decode(en_ecdh_key)
+            )
+            ecdh_pub = load_x25519_public_key(ecdh_key)
+            self._remember_peer_ecdh(user_id, ecdh_key)
+            return ecdh_pub
+        except Exception as e:
+            print(f"[系统消息] 用户 {user_id} 的 ecdhKey 校验失败，回退到 RSA: {e}")
+            return None
+
+    def _load_known_ecdh(self):
+        try:
+            with open(self._known_ecdh_path, "rb") as f:
+                return {int(k): v for k, v in json_codec.loads(f.read()).items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"[密钥] 读取已知 X25519 公钥失败: {e}")
+            return {}
+
+    def _remember_peer_ecdh(self, peer_id, ecdh_key):
+        """记录对方最新的 X25519 公钥（只在变化时写盘）"""
+        with self._known_ecdh_lock:
+            if self._known_ecdh.get(peer_id) == ecdh_key:
+                return
+            self._known_ecdh[peer_id] = ecdh_key
+            data = json_codec.dumpb(self._known_ecdh)
+            try:
+                tmp_path = self._known_ecdh_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._known_ecdh_path)
+            except OSError as e:
+                print(f"[密钥] 保存 X25519 公钥失败: {e}")
+
+    def _load_retired_streams(self):
+        try:
+            with open(self._retired_path, "rb") as f:
+                return OrderedDict(json_codec.loads(f.read()))
+        except FileNotFoundError:
+            return OrderedDict()
+        except Exception as e:
+            print(f"[序号] 读取已结束会话的记录失败: {e}")
+            return OrderedDict()
+
+    def _save_retired_streams(self):
+        data = json_codec.dumpb(self._retired_streams)
+        try:
+            tmp_path = self._retired_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._retired_path)
+        except OSError as e:
+            print(f"[序号] 保存已结束会话的记录失败: {e}")
+
+    @staticmethod
+    def _stream_digest(stream_key):
+        from_id, group_id, aes_key = stream_key
+        data = f"{from_id}|{group_id}|{aes_key}".encode()
+        return hashlib.sha256(data).hexdigest()[:32]
+
+    def _retire_stream(self, stream_key, tracker):
+        """丢弃某个会话的去重状态前记下已见过的最大序号"""
+        if not tracker.high_water:
+            return
+        digest = self._stream_digest(stream_key)
+        high_water = max(self._retired_streams.pop(digest, 0), tracker.high_water)
+        self._retired_streams[digest] = high_water
+        while len(self._retired_streams) > MAX_RETIRED_STREAMS:
+            self._retired_streams.popitem(last=False)
+
+    def _peer_ecdh_key(self, peer_id):
+        """对方的 X25519 公钥：优先用在线列表中的，离线时用保存过的"""
+        ecdh_pub = self.peer_ecdh.get(peer_id)
+        if ecdh_pub is not None:
+            return ecdh_pub
+        ecdh_key = self._known_ecdh.get(int(peer_id))
+        if ecdh_key is None:
+            raise KeyError(f"没有用户 {peer_id} 的 X25519 公钥")
+        return load_x25519_public_key(ecdh_key)
+
+    def unwrap_session_key(self, peer_id, aes_key):
+        """根据 aesKey 字段还原会话密钥：v2 用 X25519 + HKDF 派生，否则用 RSA 私钥解包"""
+        cache_key = (peer_id, aes_key)
+        K = self.session_key_cache.get(cache_key)
+        if K is not None:
+            return K
+
+        if aes_key.startswith(ECDH_KEY_PREFIX):
+            salt = base64.b64decode(aes_key[len(ECDH_KEY_PREFIX) :])
+            K = derive_session_key(
+                self.ecdh_priv, self._peer_ecdh_key(peer_id), salt, self.my_id, peer_id
+            )
+        else:
+            K = rsa_decrypt(self.priv_key, base64.b64decode(aes_key))
+
+        _bounded_put(self.session_key_cache, cache_key, K, MAX_CACHED_KEYS)
+        return K
+
+    async def _unwrap_session_key_async(self, peer_id, aes_key):
+        """缓存命中直接返回，否则在线程池中解包，不阻塞事件循环"""
+        K = self.session_key_cache.get((peer_id, aes_key))
+        if K is not None:
+            return K
+        return await self.crypto.run(self.unwrap_session_key, peer_id, aes_key)
+
+    def _establish_v2_key(self, target_id):
+        """协议 v2：本地派生会话密钥，aesKey 只携带 salt，不需要密钥交换往返"""
+        salt = os.urandom(16)
+        K = derive_session_key(
+            self.ecdh_priv, self.peer_ecdh[target_id], salt, self.my_id, target_id
+        )
+        aes_key = ECDH_KEY_PREFIX + base64.b64encode(salt).decode()
+        _bounded_put(self.session_key_cache, (target_id, aes_key), K, MAX_CACHED_KEYS)
+        self._reset_send_seq(target_id)
+        self.sym_keys[target_id] = K
+        self.sym_aeskeysb64[target_id] = aes_key
+        self.key_status[target_id] = "confirmed"
+        print(f"[密钥派生] 与用户 {target_id} 使用 X25519 (v2) 会话密钥")
 
     async def handle_user_message(self, msg):
         from_id = msg["fromId"]
+        # 群组消息的发送方也计入 LRU，caps、锁、序号状态随之淘汰
+        self._touch_peer(from_id)
+        caps = msg.get("caps")
+        if caps is not None:
+            self.peer_caps[from_id] = set(caps.split(","))
+
+        if msg.get("error") == V2_REJECTED:
+            self._on_v2_rejected(from_id)
+            return
+
+        if msg.get("groupId") is not None:
+            await self.handle_group_message(msg)
+            return
+
         message = msg.get("message", "")
         aes_key = msg.get("aesKey", "")
 
+        # 协议 v2：直接派生密钥并解密
+        if aes_key.startswith(ECDH_KEY_PREFIX):
+            try:
+                # 只用于解密；回复时用本端自己的 salt 派生新的会话密钥（见
+                # _establish_v2_key），不同方向、不同会话不会共用同一个密钥
+                K = await self._unwrap_session_key_async(from_id, aes_key)
+                if not message:
+                    return
+
+                await self._accept_message(msg, K, from_id)
+
+            except Exception as e:
+                print(f"[消息解密错误] {str(e)}")
+                if message:
+                    await self._reject_v2_message(from_id)
+            return
+
         # 处理密钥交换
         if not message and aes_key:
             try:
-                received_key = rsa_decrypt(self.priv_key, base64.b64decode(aes_key))
+                received_key = await self.crypto.run(
+                    rsa_decrypt, self.priv_key, base64.b64decode(aes_key)
+                )
 
                 if from_id in self.sym_keys:
                     if self.sym_keys[from_id] == received_key:
@@ -157,23 +584,30 @@ class WSClient:
                         self.key_status[from_id] = "error"
 
                 else:
+                    self._reset_send_seq(from_id)
                     self.sym_keys[from_id] = received_key
                     self.key_status[from_id] = "pending"
 
-                    peer_pub = load_public_key(self.peer_pubkeys[from_id])
-                    confirm_key = rsa_encrypt(peer_pub, received_key)
+                    confirm_key = await self.crypto.run(
+                        rsa_encrypt, self.peer_pubkeys[from_id], received_key
+                    )
+                    # 之后回复消息时携带用对方公钥包装的同一密钥
+                    self.sym_aeskeysb64[from_id] = base64.b64encode(
+                        confirm_key
+                    ).decode()
 
                     # 使用异步锁序列化所有发送，防止并发导致的协议错误
                     if not self._async_lock:
                         self._async_lock = asyncio.Lock()
                     async with self._async_lock:
                         await self.ws.send(
-                            json.dumps(
+                            json_codec.dumps(
                                 {
                                     "fromId": self.my_id,
                                     "toId": from_id,
                                     "message": "",
                                     "aesKey": base64.b64encode(confirm_key).decode(),
+                                    "caps": LOCAL_CAPS,
                                 }
                             )
                         )
@@ -187,6 +621,11 @@ class WSClient:
 
         if message:
             try:
+                if from_id not in self.sym_keys and aes_key:
+                    # 本端的状态被淘汰后对方仍在用已确认的密钥：帧里的 aesKey
+                    # 就是用本端公钥包装的会话密钥，解包后恢复会话
+                    await self._restore_v1_session(from_id, aes_key)
+
                 if from_id not in self.sym_keys:
                     print(f"[错误] 与用户 {from_id} 尚未建立安全连接")
                     return
@@ -195,18 +634,277 @@ class WSClient:
                     print(f"[错误] 与用户 {from_id} 的密钥尚未确认")
                     return
 
-                plaintext = self.decrypt_message(from_id, message)
-                print(f"[收到消息] 来自 {from_id}: {plaintext}")
-                import requests
-
-                requests.post(
-                    f"http://{self.flask_server}/push",
-                    json={"fromId": from_id, "content": plaintext},
-                )
+                await self._accept_message(msg, self.sym_keys[from_id], from_id)
 
             except Exception as e:
                 print(f"[消息解密错误] {str(e)}")
 
+    async def _restore_v1_session(self, peer_id, aes_key):
+        """从对方消息帧携带的包装密钥恢复 v1 会话，回复时继续使用同一密钥"""
+        K = await self._unwrap_session_key_async(peer_id, aes_key)
+        pub_pem = self.peer_pubkeys.get(peer_id)
+        if pub_pem is None:
+            raise ValueError(f"没有用户 {peer_id} 的公钥，无法恢复会话")
+        wrapped = await self.crypto.run(rsa_encrypt, pub_pem, K)
+        if peer_id in self.sym_keys:
+            return  # 解包期间已经重新建立了会话
+        self._reset_send_seq(peer_id)
+        self.sym_keys[peer_id] = K
+        self.sym_aeskeysb64[peer_id] = base64.b64encode(wrapped).decode()
+        self.key_status[peer_id] = "confirmed"
+        print(f"[密钥恢复] 从消息中恢复与用户 {peer_id} 的会话密钥")
+
+    async def _reject_v2_message(self, from_id):
+        """v2 消息无法解密（对方用了本端未上传或已更换的 X25519 公钥）：
+        告知浏览器有一条消息丢失，并通知对方改用 RSA 密钥交换"""
+        await self._push_async({"fromId": from_id, "content": UNDECRYPTABLE})
+        if self.ws is None:
+            return
+        if not self._async_lock:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            await self.ws.send(
+                json_codec.dumps(
+                    {
+                        "fromId": self.my_id,
+                        "toId": from_id,
+                        "message": "",
+                        "aesKey": "",
+                        "caps": LOCAL_CAPS,
+                        "error": V2_REJECTED,
+                    }
+                )
+            )
+
+    def _on_v2_rejected(self, peer_id):
+        """对方无法解密本端的 v2 消息：丢弃 v2 会话密钥，之后与该用户使用 v1"""
+        print(f"[协议协商] 用户 {peer_id} 无法解密 v2 消息，改用 RSA 密钥交换")
+        self.v2_rejected.add(peer_id)
+        if self.sym_aeskeysb64.get(peer_id, "").startswith(ECDH_KEY_PREFIX):
+            for state in (self.sym_keys, self.sym_aeskeysb64, self.key_status):
+                state.pop(peer_id, None)
+            self._reset_send_seq(peer_id)
+
+    async def handle_group_message(self, msg):
+        """群组消息：aesKey 是用本人公钥包装的群组密钥，同一密钥周期只解包一次"""
+        group_id = msg["groupId"]
+        aes_key = msg.get("aesKey", "")
+        try:
+            K = self.group_keys.get(aes_key)
+            if K is None:
+                K = await self.crypto.run(
+                    rsa_decrypt, self.priv_key, base64.b64decode(aes_key)
+                )
+                _bounded_put(self.group_keys, aes_key, K, MAX_CACHED_KEYS)
+
+            await self._accept_message(msg, K, group_id, group_id)
+
+        except Exception as e:
+            print(f"[群消息解密错误] {str(e)}")
+
+    async def _accept_message(self, msg, K, peer_id, group_id=None):
+        """解密一条消息并交付；带 seq 的帧先去重、重排，再按序交付"""
+        from_id = msg["fromId"]
+        aad = None
+        if msg.get("seq") is not None:
+            aad = seq_aad(from_id, self.my_id, group_id)
+        # 先解密再去重：使用加密在内、受认证保护的序号，伪造的 seq 不会污染去重窗口
+        seq, plaintext = self._open_message(msg["message"], K, aad)
+        if aad is not None and (seq is None or seq != int(msg["seq"])):
+            print(f"[消息错误] 来自 {from_id} 的消息序号不一致，丢弃")
+            return
+
+        push_data = {"fromId": from_id, "content": plaintext}
+        if group_id is not None:
+            push_data["groupId"] = group_id
+        if seq is not None:
+            push_data["seq"] = seq
+        delivery = (
+            push_data,
+            (msg["message"], peer_id, from_id, self.my_id, plaintext, group_id),
+        )
+
+        if seq is None:
+            await self._deliver(delivery)
+            return
+
+        stream_key = (from_id, group_id, msg.get("aesKey", ""))
+        tracker = self._seq_trackers.get(stream_key)
+        if tracker is None:
+            # 对方换了会话密钥（新会话或群组密钥轮换）：只保留上一个密钥的状态，
+            # 用于接收还在路上的旧消息，更早的直接丢弃
+            for item in self._prune_trackers(
+                from_id, group_id, MAX_STREAMS_PER_PEER - 1
+            ):
+                await self._deliver(item)
+            # 单聊会话的序号从 1 开始；群组新成员可能从中途加入，以首条消息为起点。
+            # 去重状态曾被丢弃的会话只接受更大的序号，旧密文不能再次重放
+            tracker = SequenceTracker(
+                start=1 if group_id is None else None,
+                floor=self._retired_streams.get(self._stream_digest(stream_key), 0),
+            )
+            self._seq_trackers[stream_key] = tracker
+
+        accepted, ready = tracker.accept(seq, delivery)
+        if not accepted:
+            print(f"[重复消息] 丢弃来自 {from_id} 的重复或过期消息 seq={seq}")
+            return
+        for item in ready:
+            await self._deliver(item)
+        self._arm_reorder_timer(stream_key, tracker)
+
+    def _prune_trackers(self, from_id, group_id, keep):
+        """只保留某个发送方（单聊或某个群组）最近 keep 个会话密钥的序号状态
+
+        返回被丢弃的重排缓冲区中已到达的消息，由调用方交付
+        """
+        streams = [k for k in self._seq_trackers if k[:2] == (from_id, group_id)]
+        ready = []
+        for key in streams[: max(0, len(streams) - keep)]:
+            tracker = self._seq_trackers.pop(key)
+            ready += tracker.flush()
+            self._retire_stream(key, tracker)
+            timer = self._reorder_timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+        return ready
+
+    def _arm_reorder_timer(self, stream_key, tracker):
+        if tracker.pending and stream_key not in self._reorder_timers:
+            self._reorder_timers[stream_key] = self.loop.call_later(
+                REORDER_TIMEOUT,
+                lambda: self.loop.create_task(self._flush_reorder(stream_key)),
+            )
+
+    async def _flush_reorder(self, stream_key):
+        """缺口等待超时：跳过缺口，交付后面已到达的消息"""
+        self._reorder_timers.pop(stream_key, None)
+        tracker = self._seq_trackers.get(stream_key)
+        if tracker is None:
+            return
+
+        lock = self._peer_locks.setdefault(stream_key[0], asyncio.Lock())
+        async with lock:
+            print(f"[消息重排] 来自 {stream_key[0]} 的消息缺口超时，跳过")
+            for item in tracker.flush():
+                await self._deliver(item)
+            self._arm_reorder_timer(stream_key, tracker)
+
+    async def _deliver(self, delivery):
+        push_data, index_args = delivery
+        self.last_activity = time.monotonic()
+        if "groupId" in push_data:
+            print(
+                f"[收到群消息] 群组 {push_data['groupId']} "
+                f"来自 {push_data['fromId']}: {push_data['content']}"
+            )
+        else:
+            print(f"[收到消息] 来自 {push_data['fromId']}: {push_data['content']}")
+        await self._push_async(push_data)
+        await self._index_message(*index_args)
+
+    async def _push_async(self, push_data):
+        try:
+            # HTTP 请求在推送线程中执行，不阻塞事件循环；单线程保证推送顺序
+            if self._push_executor is None:
+                self._push_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="push"
+                )
+            await asyncio.get_running_loop().run_in_executor(
+                self._push_executor, self._push, push_data
+            )
+        except Exception as e:
+            print(f"[推送错误] {e}")
+
+    def _touch_peer(self, peer_id):
+        """记录最近通信的用户；超过 max_peer_state 时淘汰最久未通信用户的状态"""
+        with self._lock:
+            self._peer_lru[peer_id] = None
+            self._peer_lru.move_to_end(peer_id)
+            evicted = []
+            while len(self._peer_lru) > self.max_peer_state:
+                evicted.append(self._peer_lru.popitem(last=False)[0])
+
+        for peer in evicted:
+            # 序号重排定时器等状态只能在事件循环线程中修改
+            if self.loop is not None and self.loop.is_running():
+                self.loop.call_soon_threadsafe(self._forget_peer, peer)
+            else:
+                self._forget_peer(peer)
+
+    def _forget_peer(self, peer_id):
+        """丢弃与某个用户的会话密钥、队列、序号等状态，下次通信时重新建立"""
+        if self.message_queue.get(peer_id):
+            print(
+                f"[会话] 淘汰用户 {peer_id} 的状态，丢弃 {len(self.message_queue[peer_id])} 条待发送消息"
+            )
+        for state in (
+            self.sym_keys,
+            self.sym_aeskeysb64,
+            self.key_status,
+            self.message_queue,
+            self.peer_caps,
+        ):
+            state.pop(peer_id, None)
+
+        lock = self._peer_locks.get(peer_id)
+        if lock is not None and not lock.locked():
+            del self._peer_locks[peer_id]
+        for key in [k for k in self.session_key_cache if k[0] == peer_id]:
+            self.session_key_cache.pop(key, None)
+        self._reset_send_seq(peer_id)
+        for key in [k for k in self._seq_trackers if k[0] == peer_id]:
+            self._retire_stream(key, self._seq_trackers.pop(key))
+            timer = self._reorder_timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+
+        if peer_id not in online_users:
+            self.peer_pubkeys.pop(peer_id, None)
+            self.peer_ecdh.pop(peer_id, None)
+
+    def _reset_send_seq(self, peer_id):
+        """与某个用户建立新的会话密钥时，丢弃旧密钥的发送序号"""
+        for key in [k for k in self.send_seq if k[0] == peer_id]:
+            self.send_seq.pop(key, None)
+
+    def _next_seq(self, stream_key):
+        seq = self.send_seq.get(stream_key, 0) + 1
+        self.send_seq[stream_key] = seq
+        return seq
+
+    async def _index_message(
+        self, ciphertext, peer_id, from_id, to_id, plaintext, group_id=None
+    ):
+        """写入本地搜索索引（磁盘写入放到线程池，不阻塞事件循环）"""
+        if self.search_index is None:
+            return
+        try:
+            await self.crypto.run(
+                self.search_index.add,
+                message_key(ciphertext),
+                peer_id,
+                from_id,
+                to_id,
+                plaintext,
+                None,
+                group_id,
+            )
+        except Exception as e:
+            print(f"[搜索索引错误] {str(e)}")
+
+    def _push(self, data):
+        """通过 Flask /push 把消息转给浏览器（在推送线程中调用，复用同一连接）"""
+        import requests
+
+        if self._http is None:
+            self._http = requests.Session()
+        self._http.post(
+            f"http://{self.flask_server}/push",
+            data=json_codec.dumpb(data),
+            headers={"Content-Type": "application/json"},
+        )
+
     async def _send_queued_messages(self, target_id):
         """发送队列中的消息"""
         if target_id in self.message_queue:
@@ -233,25 +931,44 @@ class WSClient:
                 raise Exception("WebSocket连接无效")
 
             K = self.sym_keys[target_id]
-            iv, ct, tag = aes_gcm_encrypt(K, msg.encode())
-            final = iv + ct + tag
-
             aes_key = self.sym_aeskeysb64[target_id]
+            peer_caps = self.peer_caps.get(target_id, ())
+            # 对方声明支持压缩时，大消息先压缩再加密
+            payload = encode_payload(msg, choose_algorithm(peer_caps))
 
-            data = {
-                "fromId": self.my_id,
-                "toId": target_id,
-                "message": base64.b64encode(final).decode(),
-                "aesKey": aes_key,
-            }
-            # print(data)
+            # 序号分配、加密与发送在同一把锁内完成，线上顺序与序号一致
             async with self._async_lock:
-                await ws.send(json.dumps(data))
+                data = {
+                    "fromId": self.my_id,
+                    "toId": target_id,
+                    "aesKey": aes_key,
+                    "caps": LOCAL_CAPS,
+                }
+                if "seq" in peer_caps:
+                    seq = self._next_seq((target_id, aes_key))
+                    iv, ct, tag = aes_gcm_encrypt(
+                        K,
+                        pack_seq(seq, payload),
+                        aad=seq_aad(self.my_id, target_id),
+                    )
+                    data["seq"] = seq
+                else:
+                    iv, ct, tag = aes_gcm_encrypt(K, payload)
+                data["message"] = base64.b64encode(iv + ct + tag).decode()
+                # print(data)
+                await ws.send(json_codec.dumps(data))
+
+            await self._index_message(
+                data["message"], target_id, self.my_id, target_id, msg
+            )
 
         except Exception as e:
             print(f"[消息发送错误] {str(e)}")
             raise
 
+    def queue_full(self, target_id):
+        return len(self.message_queue.get(target_id, ())) >= self.max_queued
+
     def send_encrypted_message(self, target_id, msg):
         print("[发送消息] 发送加密消息到用户")
 
@@ -272,11 +989,27 @@ class WSClient:
         if target_id not in self.peer_pubkeys:
             print(f"[错误] 未知用户: {target_id}")
             return False
+        self._touch_peer(target_id)
+
+        # 双方的 X25519 公钥都已上传时直接派生会话密钥，跳过 RSA 密钥交换
+        if (
+            target_id not in self.sym_keys
+            and target_id in self.peer_ecdh
+            and target_id not in self.v2_rejected
+            and self.ecdh_published
+        ):
+            try:
+                self._establish_v2_key(target_id)
+            except Exception as e:
+                print(f"[密钥派生错误] {e}，回退到 RSA 密钥交换")
 
         if (
             target_id not in self.sym_keys
             or self.key_status.get(target_id) != "confirmed"
         ):
+            if self.queue_full(target_id):
+                print(f"[错误] 发往用户 {target_id} 的待发送队列已满")
+                return False
             self.message_queue.setdefault(target_id, [])
             self.message_queue[target_id].append(msg)
 
@@ -284,6 +1017,7 @@ class WSClient:
             if target_id not in self.sym_keys:
                 try:
                     K = gen_sym_key()
+                    self._reset_send_seq(target_id)
                     self.sym_keys[target_id] = K
                     self.key_status[target_id] = "pending"
 
@@ -296,12 +1030,13 @@ class WSClient:
 
                     encK = rsa_encrypt(peer_pub, K)
                     print(f"key:{K}")
-                    payload = json.dumps(
+                    payload = json_codec.dumps(
                         {
                             "fromId": self.my_id,
                             "toId": target_id,
                             "message": "",
                             "aesKey": base64.b64encode(encK).decode(),
+                            "caps": LOCAL_CAPS,
                         }
                     )
 
@@ -328,3 +1063,189 @@ class WSClient:
         coro = self._send_message(target_id, msg)
         asyncio.run_coroutine_threadsafe(coro, self.loop)
         return True
+
+    # === 群组 / 广播 ===#
+
+    def create_group(self, group_id, members):
+        with self._lock:
+            group = GroupSession(group_id, set(members) - {self.my_id})
+            self.groups[group_id] = group
+        return group
+
+    def update_group_members(self, group_id, add=(), remove=()):
+        with self._lock:
+            group = self.groups.get(group_id)
+            if group is None:
+                return None
+            group.add_members(set(add) - {self.my_id})
+            group.remove_members(remove)
+        return group
+
+    def send_group_message(self, group_id, msg):
+        """群组消息只做一次 AES 加密，每个成员只附带各自的包装密钥
+
+        self._lock 只在读取成员、密钥周期和分配序号时持有；压缩、加密和补包装都在锁外，
+        不阻塞每帧都要拿这把锁的事件循环线程（_touch_peer）
+        """
+        if not self.loop:
+            print("[错误] 事件循环未初始化")
+            return False
+
+        self._prewrap_group_key(group_id)
+        with self._lock:
+            ws = self.ws
+            connected = self.connected
+            group = self.groups.get(group_id)
+            members = list(group.members) if group is not None else []
+
+        if not ws or not connected:
+            print("[错误] WebSocket 未连接，无法发送消息")
+            return False
+        if group is None:
+            print(f"[错误] 未知群组: {group_id}")
+            return False
+
+        recipients = [m for m in members if m in self.peer_pubkeys]
+        # 同一密文发给所有成员，压缩和序号都要所有成员支持才启用
+        common_caps = (
+            set.intersection(*[self.peer_caps.get(m, set()) for m in recipients])
+            if recipients
+            else set()
+        )
+        payload = encode_payload(msg, choose_algorithm(common_caps))
+
+        with self._lock:
+            epoch, key = group.epoch, group.key
+            # 期间离开的成员不能拿到当前密钥
+            recipients = [
+                (m, self.peer_pubkeys[m])
+                for m in recipients
+                if m in group.members and m in self.peer_pubkeys
+            ]
+            wraps = [(m, pub, group.cached_wrap(m, pub)) for m, pub in recipients]
+            if wraps:
+                group.mark_distributed()
+            seq = None
+            if "seq" in common_caps:
+                # 每个群组只记当前密钥周期的序号，轮换后从 1 重新开始；
+                # 并发发送时线上顺序可能与序号不同，由接收端重排
+                last_epoch, seq = self.group_seq.get(group_id, (epoch, 0))
+                seq = seq + 1 if last_epoch == epoch else 1
+                self.group_seq[group_id] = (epoch, seq)
+
+        if seq is not None:
+            iv, ct, tag = aes_gcm_encrypt(
+                key, pack_seq(seq, payload), aad=seq_aad(self.my_id, None, group_id)
+            )
+        else:
+            iv, ct, tag = aes_gcm_encrypt(key, payload)
+        message_b64 = base64.b64encode(iv + ct + tag).decode()
+
+        frames = []
+        new_wraps = []
+        for member_id, pub_pem, aes_key in wraps:
+            if aes_key is None:
+                # 预包装之后才加入的成员，补包装
+                try:
+                    aes_key = GroupSession.wrap_key(key, pub_pem)
+                except Exception as e:
+                    print(f"[群组密钥包装错误] 用户 {member_id}: {e}")
+                    continue
+                new_wraps.append((member_id, pub_pem, aes_key))
+            frames.append(
+                {
+                    "fromId": self.my_id,
+                    "toId": member_id,
+                    "groupId": group_id,
+                    "message": message_b64,
+                    "aesKey": aes_key,
+                    "caps": LOCAL_CAPS,
+                }
+            )
+            if seq is not None:
+                frames[-1]["seq"] = seq
+
+        if new_wraps:
+            with self._lock:
+                for member_id, pub_pem, aes_key in new_wraps:
+                    group.store_wrap(epoch, member_id, pub_pem, aes_key)
+
+        if not frames:
+            print(f"[群组发送] 群组 {group_id} 没有可达成员")
+            return True
+
+        print(f"[群组发送] 群组 {group_id} -> {len(frames)} 位成员")
+        asyncio.run_coroutine_threadsafe(self._send_frames(frames), self.loop)
+
+        if self.search_index is not None:
+            try:
+                self.search_index.add(
+                    message_key(message_b64),
+                    group_id,
+                    self.my_id,
+                    None,
+                    msg,
+                    group_id=group_id,
+                )
+            except Exception as e:
+                print(f"[搜索索引错误] {str(e)}")
+        return True
+
+    def _prewrap_group_key(self, group_id, attempts=3):
+        """在 self._lock 外为还没有包装结果的成员包装群组密钥
+
+        密钥轮换后首次发送需要对每个成员做 RSA 公钥运算，放在锁外执行，事件循环线程
+        （_touch_peer 等）不会被阻塞；期间密钥再次轮换时重试，仍未完成的在发送时补包装。
+        """
+        for _ in range(attempts):
+            with self._lock:
+                group = self.groups.get(group_id)
+                if group is None:
+                    return
+                epoch, key = group.epoch, group.key
+                pending = [
+                    (m, self.peer_pubkeys[m])
+                    for m in group.members
+                    if m in self.peer_pubkeys
+                    and group.cached_wrap(m, self.peer_pubkeys[m]) is None
+                ]
+            if not pending:
+                return
+
+            wrapped = []
+            for member_id, pub_pem in pending:
+                try:
+                    wrapped.append(
+                        (member_id, pub_pem, GroupSession.wrap_key(key, pub_pem))
+                    )
+                except Exception as e:
+                    print(f"[群组密钥包装错误] 用户 {member_id}: {e}")
+
+            with self._lock:
+                for member_id, pub_pem, enc_key in wrapped:
+                    if not group.store_wrap(epoch, member_id, pub_pem, enc_key):
+                        break  # 密钥已轮换，重新包装
+
+    def broadcast_message(self, msg):
+        """广播给当前所有在线用户（保留群组 BROADCAST_GROUP）"""
+        members = set(online_users) - {self.my_id}
+        with self._lock:
+            group = self.groups.get(BROADCAST_GROUP)
+            if group is None:
+                group = GroupSession(BROADCAST_GROUP, members)
+                self.groups[BROADCAST_GROUP] = group
+            else:
+                group.set_members(members)
+        return self.send_group_message(BROADCAST_GROUP, msg)
+
+    async def _send_frames(self, frames):
+        """一次拿锁批量发送多帧，避免与其他发送交错"""
+        try:
+            ws = await self.ensure_connection()
+            if not self._async_lock:
+                self._async_lock = asyncio.Lock()
+            async with self._async_lock:
+                for frame in frames:
+                    await ws.send(json_codec.dumps(frame))
+        except Exception as e:
+            print(f"[群组发送错误] {str(e)}")